@@ -2,7 +2,7 @@
 #
 
 from lib.launchpad                      import Launchpad
-from lib.bugzdb                         import BugzDB
+from lib.bugzdb                         import BugzDB, stage_dates_pivot
 from datetime                           import datetime, timezone, timedelta
 import re
 import yaml
@@ -27,6 +27,26 @@ def timestamp(mark):
         delta = 0
     return delta
 
+def yaml_timestamp(mark):
+    '''
+    timestamp() of a date from the tracking bugs cache. Dates without a timezone are
+    UTC, as Launchpad's are.
+    '''
+    if isinstance(mark, str):
+        try:
+            mark = datetime.fromisoformat(mark)
+        except ValueError:
+            return 0
+    if isinstance(mark, datetime) and mark.tzinfo is None:
+        mark = mark.replace(tzinfo=timezone.utc)
+    return timestamp(mark)
+
+def person_name(link):
+    '''
+    The name of the person a Launchpad link (.../~name) is to, without fetching them.
+    '''
+    return link.rsplit('~', 1)[-1] if link else ''
+
 def date_of_timestamp(ts):
     date = epoch + timedelta(seconds=ts)
     return date
@@ -37,8 +57,11 @@ def problem_type(lpbug):
     that the bug is about. We are looking for a "ProblemType:" line in the
     description to help.
     """
+    return description_problem_type(lpbug.description)
+
+def description_problem_type(description):
     retval = 'unknown'
-    for line in lpbug.description.split('\n'):
+    for line in description.split('\n'):
         m = re.search(r'ProblemType:\s*(.*)', line)
         if m is not None:
             retval = m.group(1)
@@ -142,12 +165,22 @@ class SRUCycleStats():
         self.regression_testing    = 0
         self.verification_testing  = 0
         self.certification_testing = 0
-
-    def load(self, id):
+        self.crank_complete        = 0
+        self.build_to_boot         = 0
+        self.boot_testing          = 0
+        self.sru_review            = 0
+        self.new_review            = 0
+        self.to_proposed           = 0
+        self.regression            = 0
+        self.automated_testing     = 0
+
+    def load(self, id, sql=None):
         q = 'select * from sru_cycle_stats where id = "%s"' % (id)
-        db = BugzDB()
+        db = BugzDB(sql)
         rec = db.fetch_one(q)
+        return self.load_record(rec)
 
+    def load_record(self, rec):
         self.id                    = rec['id']
         self.cycle                 = rec['cycle']
         self.series                = rec['series']
@@ -163,11 +196,26 @@ class SRUCycleStats():
         self.regression_testing    = rec['regression_testing']
         self.verification_testing  = rec['verification_testing']
         self.certification_testing = rec['certification_testing']
+        self.crank_complete        = rec['crank_complete']
+        self.build_to_boot         = rec['build_to_boot']
+        self.boot_testing          = rec['boot_testing']
+        self.sru_review            = rec['sru_review']
+        self.new_review            = rec['new_review']
+        self.to_proposed           = rec['to_proposed']
+        self.regression            = rec['regression']
+        self.automated_testing     = rec['automated_testing']
         return self
 
-    def store(self):
-        db = BugzDB()
-        db.update_sru_cycle_stats_table(self)
+    def store(self, sql=None, writer=None):
+        '''
+        Write the stats to the database, or stage them with the writer (a BugzWriter)
+        if one is given.
+        '''
+        if writer is not None:
+            writer.stage_stats(self)
+        else:
+            db = BugzDB(sql)
+            db.update_sru_cycle_stats_table(self)
 
 class BugTask():
     def __init__(self):
@@ -196,7 +244,7 @@ class BugTask():
 class BugTaskDB(BugTask):
     def __init__(self, record):
         super(BugTask, self).__init__()
-        self.id                    = record['id']
+        self.id                    = record['bug_id']
         self.assignee              = record['assignee']
         self.status                = record['status']
         self.importance            = record['importance']
@@ -215,7 +263,7 @@ class BugTaskDB(BugTask):
         self.owner                 = record['owner']
         self.title                 = record['title']
         self.milestone             = record['milestone']
-        self.name                  = record['name']
+        self.name                  = record['task_name']
 
 class BugTaskLP(BugTask):
     def __init__(self, lptask):
@@ -242,9 +290,33 @@ class BugTaskLP(BugTask):
         self.milestone             = lptask.milestone if lptask.milestone else ''
         self.name                  = lptask.bug_target_name
 
+class BugTaskYAML(BugTask):
+    def __init__(self, bug_id, name, task):
+        super(BugTask, self).__init__()
+        self.id                    = bug_id
+        self.assignee              = task.get('assignee') or ''
+        self.status                = task.get('status', '')
+        self.importance            = task.get('importance', '')
+        self.date_created          = yaml_timestamp(task.get('date_created'))
+        self.date_confirmed        = yaml_timestamp(task.get('date_confirmed'))
+        self.date_assigned         = yaml_timestamp(task.get('date_assigned'))
+        self.date_triaged          = yaml_timestamp(task.get('date_triaged'))
+        self.date_in_progress      = yaml_timestamp(task.get('date_in_progress'))
+        self.date_closed           = yaml_timestamp(task.get('date_closed'))
+        self.date_fix_committed    = yaml_timestamp(task.get('date_fix_committed'))
+        self.date_fix_released     = yaml_timestamp(task.get('date_fix_released'))
+        self.date_incomplete       = yaml_timestamp(task.get('date_incomplete'))
+        self.date_left_closed      = yaml_timestamp(task.get('date_left_closed'))
+        self.date_left_new         = yaml_timestamp(task.get('date_left_new'))
+        self.is_complete           = task.get('is_complete', '')
+        self.owner                 = task.get('owner', '')
+        self.title                 = task.get('title', '')
+        self.milestone             = task.get('milestone') or ''
+        self.name                  = name
+
 class Bug():
-    def __init__(self):
-        self.bdb = BugzDB()
+    def __init__(self, sql=None):
+        self.bdb = BugzDB(sql)
 
         self.id                 = ''
         self.title              = ''
@@ -269,6 +341,8 @@ class Bug():
         self.variant            = ''
         self.tasks              = {}
         self.tags               = []
+        self.activity           = []    # (task, old status, new status, timestamp, who)
+        self.activity_mark      = None  # (count, latest) of the Launchpad activity ingested
 
     def load(self, bid):
         '''
@@ -276,6 +350,25 @@ class Bug():
         '''
         q = 'select * from bugs where id = %s' % bid
         rec = self.bdb.fetch_one(q)
+        self.load_record(rec)
+
+        q = 'select * from tags where id = %s' % bid
+        recs = self.bdb.fetch_all(q)
+        for rec in recs:
+            self.tags.append(rec['tag'])
+
+        self.tasks = {}
+        q = 'select * from bug_tasks where bug_id = ?'
+        for rec in self.bdb.fetch_all(q, (self.id,)):
+            self.add_task(rec)
+
+        return self
+
+    def load_record(self, rec):
+        '''
+        Fill in the Bug's fields from a single record of the bugs table. The tags and
+        tasks are not touched.
+        '''
         self.id                 = rec['id']
         self.title              = rec['title']
         self.owner              = rec['owner']
@@ -300,27 +393,22 @@ class Bug():
         self.package            = rec['package']
         self.version            = rec['version']
         self.variant            = rec['variant']
-
-        q = 'select * from tags where id = %s' % bid
-        recs = self.bdb.fetch_all(q)
-        for rec in recs:
-            self.tags.append(rec['tag'])
-
-        self.tasks = {}
-        q = 'select * from tasks where id=%s' % self.id
-        tasks = self.bdb.fetch_all(q)
-        for rec in tasks:
-            q = 'select * from %s where id=%s' % (rec['tbl'], self.id)
-            tasks = self.bdb.fetch_all(q)
-            for task in tasks:
-                self.tasks[task['name'].replace('kernel-sru-workflow/', '')] = BugTaskDB(task)
-
         return self
 
+    def add_task(self, rec):
+        self.tasks[rec['task_name']] = BugTaskDB(rec)
+
     def load_from_lp(self, bugid, lp=None):
         if lp is None:
             lp = Launchpad('bugz')
-        lpbug = lp.service.bugs[bugid]
+        return self.load_from_lpbug(lp.service.bugs[bugid])
+
+    def load_from_lpbug(self, lpbug, mark=None):
+        '''
+        Instantiate a Bug object from a Launchpad bug that has already been fetched.
+        mark is the bug's activity mark from the database (see activity_since), when
+        it's given only the activity that's newer than it is fetched.
+        '''
         self.id                 = lpbug.id
         self.title              = lpbug.title
         self.owner              = lpbug.owner.name
@@ -336,7 +424,93 @@ class Bug():
         self.problem_type       = problem_type(lpbug)
         self.description        = lpbug.description
         self.tags               = lpbug.tags
+        self.__decode_tags_and_description()
+
+        for lptask in lpbug.bug_tasks:
+            bt = BugTaskLP(lptask)
+            # self.tasks[bt.name] = bt
+            self.tasks[bt.name.replace('kernel-sru-workflow/', '')] = bt
+
+        entries = None if mark is None else self.activity_since(lpbug, mark)
+        if entries is None:
+            entries = list(lpbug.activity)
+            stored = []
+            count, latest = 0, 0
+        else:
+            stored = [(rec['task'], rec['old_status'], rec['new_status'], rec['changed_at'], rec['who']) for rec in self.bdb.fetch_all(BugHelper.task_activity_q, (str(self.id),))]
+            count, latest = mark
+        changes = ((activity.whatchanged, activity.oldvalue, activity.newvalue, activity.datechanged, person_name(activity.person_link)) for activity in entries)
+        self.__record_task_activity(changes, timestamp)
+        self.activity = stored + self.activity
+        self.activity_mark = (count + len(entries), timestamp(entries[-1].datechanged) if entries else latest)
+        self.__apply_task_status_dates(self.__extract_task_status_dates())
+
+        return self
+
+    def activity_since(self, lpbug, mark):
+        '''
+        The bug's activity entries that came after those already ingested, going by its
+        activity mark: how many entries there were and the timestamp of the latest. The
+        entries are fetched starting with the latest one already seen, which has to be
+        where it was and changed when it did. When it isn't, or an entry is older than
+        it, the history isn't what it was taken to be and None is returned so that the
+        whole of it is walked instead.
+        '''
+        count, latest = mark
+        if count < 1:
+            return None
+        tail = lpbug.activity[count - 1:]
+        if len(tail) < 1 or timestamp(tail[0].datechanged) != latest:
+            return None
+        entries = tail[1:]
+        for activity in entries:
+            if timestamp(activity.datechanged) < latest:
+                return None
+        return entries
+
+    def load_from_yaml(self, data):
+        '''
+        Instantiate a Bug object from what a bug's YAML file in the tracking bugs cache
+        (see lib.yaml_cache) parses to. Whatever the file doesn't have is left empty.
+        '''
+        tasks = data.get('tasks') or {}
+        self.id                 = data['id']
+        self.title              = data.get('title', '')
+        self.owner              = data.get('owner', '')
+        self.owner_display_name = data.get('owner_display_name', '')
+        self.created            = yaml_timestamp(data.get('date_created', tasks.get('kernel-sru-workflow', {}).get('date_created')))
+        self.last_message       = yaml_timestamp(data.get('last_message'))
+        self.last_updated       = yaml_timestamp(data.get('last_updated'))
+        self.private            = data.get('private', '')
+        self.security           = data.get('security_related', '')
+        self.duplicate          = data.get('duplicate_of')
+        self.heat               = data.get('heat', 0)
+        self.is_expirable       = data.get('is_expirable', '')
+        self.description        = data.get('description') or ''
+        self.problem_type       = description_problem_type(self.description)
+        self.tags               = data.get('tags') or []
+        self.__decode_tags_and_description()
+
+        # The cache's own notion of the cycle, for bugs without a cycle tag.
+        #
+        if not self.cycle and data.get('cycle'):
+            self.cycle = str(data['cycle'])
+            self.spin = str(data.get('spin', '0'))
+
+        for name, task in tasks.items():
+            self.tasks[name.replace('kernel-sru-workflow/', '')] = BugTaskYAML(self.id, name, task)
+
+        changes = ((activity['what-changed'], activity['old-value'], activity['new-value'], activity['date-changed'], activity.get('who', '')) for activity in data.get('history') or [])
+        self.__record_task_activity(changes, yaml_timestamp)
+        self.__apply_task_status_dates(self.__extract_task_status_dates())
+
+        return self
 
+    def __decode_tags_and_description(self):
+        '''
+        The cycle, spin, master bug, variant, series, package and version, from the
+        bug's tags, title and the swm properties at the end of its description.
+        '''
         # ____________________________________________________________________________
         #
         # Determine the cycle and the spin #
@@ -380,12 +554,10 @@ class Bug():
         #
         self.series, self.package, self.version = obtain_series_package_version(self)
 
-        for lptask in lpbug.bug_tasks:
-            bt = BugTaskLP(lptask)
-            # self.tasks[bt.name] = bt
-            self.tasks[bt.name.replace('kernel-sru-workflow/', '')] = bt
-
-        history_tasks = self.__extract_task_status_dates(lpbug)
+    def __apply_task_status_dates(self, history_tasks):
+        '''
+        Set the tasks' status dates from the history (see __extract_task_status_dates).
+        '''
         for task in history_tasks:
             for status in history_tasks[task]:
                 match status:
@@ -416,30 +588,63 @@ class Bug():
                             self.tasks[task].date_fix_released  = history_tasks[task][status]
                         except KeyError: pass
 
-        return self
+    def __record_task_activity(self, changes, to_timestamp):
+        '''
+        Keep every task status change in the bug's history, given as (what changed, old
+        value, new value, date changed, who), in self.activity. Restarts and resets of a
+        task show up as more than one change to the same status.
+        '''
+        self.activity = []
+        for whatchanged, oldvalue, newvalue, datechanged, who in changes:
+            if whatchanged.endswith('status'):
+                task = whatchanged.split(':', 1)[0]
+                if task.startswith('kernel-sru-workflow') and '/' in task:
+                    task = task.split('/')[1]
+                self.activity.append((task, oldvalue, newvalue, to_timestamp(datechanged), who or ''))
 
-    def __extract_task_status_dates(self, bug):
+    def __extract_task_status_dates(self):
+        '''
+        The date each task last changed to each status, as {task: {status: timestamp}}.
+        '''
         tasks = {}
 
-        history = bug.activity
-        for activity in history:
-            if activity.whatchanged.endswith('status'):
-                task = activity.whatchanged.split(':', 1)[0]
-                if task.startswith('kernel-sru-workflow') and '/' in task:
-                    task = task.split('/')[1]
-                tasks.setdefault(task, {})
-                # tasks[task][activity.newvalue] = str(activity.datechanged).split('.', 1)[0]
-                tasks[task][activity.newvalue] = timestamp(activity.datechanged)
+        for task, oldvalue, newvalue, changed, who in self.activity:
+            tasks.setdefault(task, {})
+            tasks[task][newvalue] = changed
         return tasks
 
-    def store(self):
-        db = BugzDB()
-        db.update_bugs_table(self)
-        db.update_tasks_tables(self)
+    def store(self, writer=None):
+        '''
+        Write the bug to the database, or stage it with the writer (a BugzWriter) if one
+        is given.
+        '''
+        if writer is not None:
+            writer.stage_bug(self)
+            return
+        with self.bdb.transaction():
+            self.bdb.update_bugs_table(self)
+            self.bdb.update_tasks_tables(self)
 
 class BugHelper():
-    def __init__(self):
-        self.bdb = BugzDB()
+    # The queries behind the generators below. They are also run through EXPLAIN QUERY
+    # PLAN by "db-update maintain" (see explain_queries) so keep the two in step.
+    #
+    stable_cycles_q             = 'select distinct cycle from bugs order by cycle;'
+    last_updated_q              = 'select id, last_updated from bugs;'
+    cycle_bugs_q                = 'select id from bugs where cycle = ? order by id;'
+    series_in_cycle_q           = 'select distinct series from bugs where cycle = ? order by series;'
+    series_in_cycle_ex_q        = 'select distinct series from sru_cycle_stats where cycle = ? order by series;'
+    stats_in_cycle_and_series_q = 'select * from sru_cycle_stats where cycle = ? and series = ? and variant = "debs" order by package;'
+    cycle_stats_q               = 'select s.*, b.id as bug_id, b.spin, b.master_bug_id from sru_cycle_stats as s left join bugs as b on b.id = s.id '
+    cycle_stats_q              += 'where s.cycle = ? order by s.series, s.package;'
+    cycle_rollups_q             = 'select * from cycle_rollups where stage in (%s) order by cycle, series, stage;'
+    task_activity_q             = 'select * from task_activity where bug_id = ? order by changed_at, rowid;'
+    activity_marks_q            = 'select bug_id, count, latest from activity_marks;'
+    cycle_task_activity_q       = 'select a.* from task_activity as a join bugs as b on b.id = a.bug_id '
+    cycle_task_activity_q      += 'where b.cycle = ? and a.task = ? order by a.bug_id, a.changed_at, a.rowid;'
+
+    def __init__(self, sql=None):
+        self.bdb = BugzDB(sql)
 
     def query(self, q):
         recs = self.bdb.fetch_all(q)
@@ -447,41 +652,106 @@ class BugHelper():
             yield rec
 
     def stable_cycles(self):
-        q = 'select distinct cycle from bugs order by cycle;'
-        recs = self.bdb.fetch_all(q)
+        recs = self.bdb.fetch_all(self.stable_cycles_q)
         for rec in recs:
             if not rec['cycle'] or rec['cycle'].startswith('d') or rec['cycle'] == 'None':
                 continue
             yield rec['cycle']
 
+    def last_updated(self):
+        '''
+        A dictionary of when (timestamp) each bug in the database was last updated, keyed
+        by bug id.
+        '''
+        return {rec['id']: rec['last_updated'] for rec in self.bdb.fetch_all(self.last_updated_q)}
+
+    def activity_marks(self):
+        '''
+        The activity mark, (count, latest), of each bug that has one keyed by its id.
+        '''
+        return {rec['bug_id']: (rec['count'], rec['latest']) for rec in self.bdb.fetch_all(self.activity_marks_q)}
+
     def cycle_bugs(self, cycle):
-        q = 'select id from bugs where cycle = "%s" order by id;' % cycle
-        recs = self.bdb.fetch_all(q)
+        recs = self.bdb.fetch_all(self.cycle_bugs_q, (cycle,))
         for rec in recs:
             yield rec['id']
 
     def bugs_in_cycle(self, cycle):
-        q = 'select id from bugs where cycle = "%s" order by series;' % cycle
-        recs = self.bdb.fetch_all(q)
-        for rec in recs:
-            yield Bug().load(rec['id'])
+        for bug in self.load_cycle(cycle):
+            yield bug
 
     def series_in_cycle(self, cycle):
-        q = 'select distinct series from bugs where cycle = "%s" order by series;' % cycle
-        recs = self.bdb.fetch_all(q)
+        recs = self.bdb.fetch_all(self.series_in_cycle_q, (cycle,))
         for rec in recs:
             yield rec['series']
 
     def bugs_in_cycle_and_series(self, cycle, series):
-        q = 'select id from bugs where cycle = "%s" and series = "%s" and variant = "debs" order by package;' % (cycle, series)
-        recs = self.bdb.fetch_all(q)
-        for rec in recs:
-            yield Bug().load(rec['id'])
+        for bug in self.load_cycle(cycle, series=series, variant='debs'):
+            yield bug
+
+    def load_cycle(self, cycle, series=None, packages=None, variant=None):
+        '''
+        Load every bug of an SRU cycle along with its tags and tasks. Rather than a
+        few queries per bug (see Bug.load) three queries are made for the whole cycle
+        and the records are grouped by bug in memory.
+
+        The series, packages and variant can each be a single value or a list and
+        narrow down which bugs are loaded. The bugs are returned ordered by series
+        and package.
+        '''
+        bugs = {}
+        bugs_q, tags_q, tasks_q, params = self.load_cycle_queries(cycle, series, packages, variant)
+        for rec in self.bdb.fetch_all(bugs_q, params):
+            bugs[rec['id']] = Bug(self.bdb.sql).load_record(rec)
+
+        for rec in self.bdb.fetch_all(tags_q, params):
+            bugs[rec['id']].tags.append(rec['tag'])
+
+        for rec in self.bdb.fetch_all(tasks_q, params):
+            bugs[rec['bug_id']].add_task(rec)
+
+        return list(bugs.values())
+
+    def load_cycle_queries(self, cycle, series=None, packages=None, variant=None):
+        where  = 'cycle = ?'
+        params = [cycle]
+        for column, values in (('series', series), ('package', packages), ('variant', variant)):
+            if values is None:
+                continue
+            if isinstance(values, str):
+                values = [values]
+            where += ' and %s in (%s)' % (column, ','.join('?' * len(values)))
+            params += list(values)
+        selected = 'select id from bugs where %s' % where
+
+        bugs_q  = 'select * from bugs where %s order by series, package;' % where
+        tags_q  = 'select id, tag from tags where id in (%s);' % selected
+        tasks_q = 'select * from bug_tasks where bug_id in (%s);' % selected
+        return bugs_q, tags_q, tasks_q, params
+
+    def explain_queries(self, cycle, series):
+        '''
+        The name, query and parameters of each of the queries made by the generators
+        above, for the given cycle and series.
+        '''
+        bugs_q, tags_q, tasks_q, params = self.load_cycle_queries(cycle, series=series, variant='debs')
+        return [
+            ('stable_cycles',             self.stable_cycles_q,             ()),
+            ('cycle_bugs',                self.cycle_bugs_q,                (cycle,)),
+            ('series_in_cycle',           self.series_in_cycle_q,           (cycle,)),
+            ('load_cycle (bugs)',         bugs_q,                           params),
+            ('load_cycle (tags)',         tags_q,                           params),
+            ('load_cycle (tasks)',        tasks_q,                          params),
+            ('series_in_cycle_ex',        self.series_in_cycle_ex_q,        (cycle,)),
+            ('stats_in_cycle_and_series', self.stats_in_cycle_and_series_q, (cycle, series)),
+            ('cycle_stats',               self.cycle_stats_q,               (cycle,)),
+            ('cycle_rollups',             self.cycle_rollups_q % '?',       ('total',)),
+            ('cycle_task_activity',       self.cycle_task_activity_q,       (cycle, 'regression-testing')),
+        ]
 
     def series_in_cycle_ex(self, cycle):
         cycle_series = []
-        q = 'select distinct series from sru_cycle_stats where cycle = "%s" order by series;' % cycle
-        recs = self.bdb.fetch_all(q)
+        recs = self.bdb.fetch_all(self.series_in_cycle_ex_q, (cycle,))
         for rec in recs:
             cycle_series.append(rec['series'])
 
@@ -490,9 +760,51 @@ class BugHelper():
                 yield series
 
     def stats_in_cycle_and_series(self, cycle, series):
-        q = 'select * from sru_cycle_stats where cycle = "%s" and series = "%s" and variant = "debs" order by package;' % (cycle, series)
-        recs = self.bdb.fetch_all(q)
+        recs = self.bdb.fetch_all(self.stats_in_cycle_and_series_q, (cycle, series))
         for rec in recs:
-            # yield SRUCycleStats().load(cycle, series, rec['package'])
-            yield SRUCycleStats().load(rec['id'])
+            yield SRUCycleStats().load_record(rec)
 
+    def cycle_stats(self, cycle):
+        '''
+        The sru_cycle_stats records (all variants) of a cycle, ordered by series and
+        package, each along with the bug's spin and master_bug_id (bug_id is None if the
+        bug isn't in the database).
+        '''
+        return self.bdb.fetch_all(self.cycle_stats_q, (cycle,))
+
+    def cycle_rollups(self, stages):
+        '''
+        The cycle_rollups records of the given stages (sru_cycle_stats columns), ordered
+        by cycle, series and stage.
+        '''
+        return self.bdb.fetch_all(self.cycle_rollups_q % ', '.join('?' * len(stages)), stages)
+
+    def task_activity(self, bug_id):
+        '''
+        Every task status change of the bug, in the order they happened.
+        '''
+        return self.bdb.fetch_all(self.task_activity_q, (str(bug_id),))
+
+    def cycle_task_activity(self, cycle, task):
+        '''
+        The status changes of a task of every bug in the cycle, by bug and in the order
+        they happened. A task that was restarted changes to the same status more than once.
+        '''
+        return self.bdb.fetch_all(self.cycle_task_activity_q, (cycle, task))
+
+    def stage_dates(self, cycle, stages):
+        '''
+        The dates each of the stages (entries of SRUCycleStages) ended and started for
+        each bug of a cycle, as {bug id: [(end, start), ...]} with the stages in the
+        order given. The bugs are those of the cycle's sru_cycle_stats records (see
+        cycle_stats), even when a bug has since moved to another cycle.
+        '''
+        pivot, params, edges = stage_dates_pivot(stages)
+        tasks = sorted(set(params))     # Only the tasks the stages need are joined
+        q  = 'select s.id, %s from sru_cycle_stats as s left join bug_tasks as t on t.bug_id = s.id ' % pivot
+        q += 'and t.task_name in (%s) ' % ', '.join('?' * len(tasks))
+        q += 'where s.cycle = ? group by s.id;'
+        dates = {}
+        for rec in self.bdb.fetch_all(q, params + tasks + [cycle]):
+            dates[rec['id']] = [(rec[end], rec[start]) for end, start in edges]
+        return dates
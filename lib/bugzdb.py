@@ -1,51 +1,403 @@
 #!/usr/bin/env python3
 
+from contextlib                         import contextmanager
+import atexit
+import fcntl
 import os
 import sqlite3
+import sys
+import threading
+import yaml
+from lib.sketch                         import QuantileSketch
+
+# How the database connections are set up. Any of these can be overridden in the
+# "database" section of config.yaml.
+#
+DatabaseDefaults = {
+    'journal_mode' : 'wal',                    # Readers don't block behind a writer (or the other way around)
+    'synchronous'  : 'normal',                 # With WAL only a checkpoint has to sync
+    'busy_timeout' : 30000,                    # Milliseconds to wait on a locked database before giving up
+    'cache_size'   : -65536,                   # Negative is KiB, positive is pages
+}
+
+def database_settings():
+    '''
+    The database connection settings: the defaults along with anything given in the
+    "database" section of the config.yaml next to the tools.
+    '''
+    settings = dict(DatabaseDefaults)
+    cfg_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config.yaml')
+    try:
+        with open(cfg_path, 'r') as f:
+            cfg = yaml.safe_load(f.read())
+        settings.update(cfg.get('database') or {})
+    except (OSError, AttributeError):
+        pass
+    return settings
+
+class ConnectionManager():
+    '''
+    Hands out one sqlite connection per database for each process and thread. All of
+    the BugzDB instances the tools create share that connection rather than opening
+    their own, and the connections are closed when the process exits.
+
+    Setting BUGZDB_STATS in the environment prints how many connections were opened
+    during the run when the process exits.
+    '''
+    def __init__(self):
+        self.opened = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.connections = []                  # (pid, connection) for every connection opened
+        self.depth = {}                        # id(connection) -> transaction scope nesting level
+        self.settings = None
+        atexit.register(self.close_all)
+
+    def connection(self, db_path):
+        '''
+        The connection to db_path for the calling process and thread, opened on first use.
+        '''
+        pid = os.getpid()
+        if getattr(self.local, 'pid', None) != pid:
+            # Connections must not be shared across a fork, start over in the child.
+            #
+            self.local.pid = pid
+            self.local.connections = {}
+
+        sql = self.local.connections.get(db_path)
+        if sql is None:
+            if self.settings is None:
+                self.settings = database_settings()
+            sql = sqlite3.connect(db_path, timeout=self.settings['busy_timeout'] / 1000, check_same_thread=False)
+            sql.row_factory = sqlite3.Row
+            self.configure(sql)
+            self.local.connections[db_path] = sql
+            with self.lock:
+                self.opened += 1
+                self.connections.append((pid, sql))
+        return sql
+
+    def configure(self, sql):
+        settings = self.settings
+        sql.execute('pragma busy_timeout = %d;' % int(settings['busy_timeout']))
+        sql.execute('pragma cache_size = %d;' % int(settings['cache_size']))
+        sql.execute('pragma synchronous = %s;' % settings['synchronous'])
+        try:
+            sql.execute('pragma journal_mode = %s;' % settings['journal_mode'])
+        except sqlite3.OperationalError:
+            # The journal mode can't be changed on a database we can only read, it's
+            # whatever the last writer left it as.
+            #
+            pass
+
+    @contextmanager
+    def transaction(self, sql):
+        '''
+        A transaction scope on the connection. The work done inside it is committed when
+        the outermost scope exits and rolled back if it exits with an exception. Nested
+        scopes join the enclosing one.
+        '''
+        depth = self.depth.get(id(sql), 0)
+        self.depth[id(sql)] = depth + 1
+        try:
+            yield sql
+            if depth == 0:
+                sql.commit()
+        except BaseException:
+            if depth == 0:
+                sql.rollback()
+            raise
+        finally:
+            self.depth[id(sql)] = depth
+
+    def in_transaction(self, sql):
+        return self.depth.get(id(sql), 0) > 0
+
+    def close_all(self):
+        pid = os.getpid()
+        with self.lock:
+            for owner, sql in self.connections:
+                if owner == pid:
+                    sql.close()
+            self.connections = [c for c in self.connections if c[0] != pid]
+        if os.environ.get('BUGZDB_STATS'):
+            print(f'bugzdb: {self.opened} sqlite connection(s) opened', file=sys.stderr)
+
+connections = ConnectionManager()
 
 class SQLBase():
 
     # __init__
     #
-    def __init__(self, db):
-        try:
-            self.sql = sqlite3.connect(db)
-            self.sql.row_factory = sqlite3.Row
-        except Exception as e:
-            self.sql.rollback()
-            self.sql.close()
-            raise e
+    def __init__(self, db, sql=None):
+        if sql is None:
+            sql = connections.connection(db)
+        self.sql = sql
+
+    def transaction(self):
+        return connections.transaction(self.sql)
+
+    def complete(self):
+        '''
+        Commit the work done so far. Inside a transaction scope nothing is done here, the
+        scope commits when it ends.
+        '''
+        if not connections.in_transaction(self.sql):
+            self.sql.commit()
 
-    def commit(self, query):
+    def commit(self, query, params=()):
         try:
             cursor = self.sql.cursor()
-            cursor.execute(query)
-            self.sql.commit()
+            cursor.execute(query, params)
+            self.complete()
         except Exception as e:
             self.sql.rollback()
-            self.sql.close()
             raise e
 
-    def query(self, query):
+    def query(self, query, params=()):
         cursor = self.sql.cursor()
-        cursor.execute(query)
+        cursor.execute(query, params)
         return cursor
 
-    def fetch_all(self, query):
-        results = self.query(query).fetchall()
+    def fetch_all(self, query, params=()):
+        results = self.query(query, params).fetchall()
         return results
 
-    def fetch_one(self, query):
-        results = self.query(query).fetchone()
+    def fetch_one(self, query, params=()):
+        results = self.query(query, params).fetchone()
         return results
 
+# The values for the BugzDB insert statements. Text columns get the string form of
+# the value, as they always have, while timestamps and durations are left as they are.
+#
+def bug_row(bug):
+    return (
+        str(bug.id),
+        str(bug.title),
+        str(bug.owner),
+        str(bug.owner_display_name),
+        bug.created,
+        bug.last_message,
+        bug.last_updated,
+        str(bug.private),
+        str(bug.security),
+        str(bug.duplicate),
+        bug.heat,
+        str(bug.is_expirable),
+        str(bug.problem_type),
+        str(bug.description),
+        str(bug.master_bug_id),
+        str(bug.cycle),
+        str(bug.spin),
+        str(bug.series),
+        str(bug.package),
+        str(bug.version),
+        str(bug.variant),
+    )
+
+def tag_rows(bug):
+    return [(str(bug.id), str(tag)) for tag in bug.tags]
+
+def task_activity_rows(bug):
+    return [(str(bug.id), task, str(old), str(new), changed, str(who)) for task, old, new, changed, who in bug.activity]
+
+def activity_mark_rows(bug):
+    if bug.activity_mark is None:
+        return []
+    return [(str(bug.id),) + tuple(bug.activity_mark)]
+
+def task_rows(bug):
+    rows = []
+    for taskname in bug.tasks:
+        task = bug.tasks[taskname]
+        rows.append((
+            str(bug.id),
+            taskname,
+            str(task.assignee),
+            str(task.status),
+            str(task.importance),
+            task.date_created,
+            task.date_confirmed,
+            task.date_assigned,
+            task.date_closed,
+            task.date_fix_committed,
+            task.date_fix_released,
+            task.date_in_progress,
+            task.date_incomplete,
+            task.date_left_closed,
+            task.date_left_new,
+            task.date_triaged,
+            str(task.is_complete),
+            str(task.owner),
+            str(task.title),
+            str(task.milestone),
+        ))
+    return rows
+
+# The sru_cycle_stats columns in the order sru_cycle_stats_row() has them.
+#
+sru_cycle_stats_columns = (
+    'id', 'series', 'package', 'cycle', 'variant', 'total', 'ready', 'waiting', 'crank', 'build', 'review_start', 'review',
+    'regression_testing', 'verification_testing', 'certification_testing', 'crank_complete', 'build_to_boot', 'boot_testing',
+    'sru_review', 'new_review', 'to_proposed', 'regression', 'automated_testing',
+)
+
+def sru_cycle_stats_row(cycle):
+    return (
+        str(cycle.id),
+        str(cycle.series),
+        str(cycle.package),
+        str(cycle.cycle),
+        str(cycle.variant),
+        cycle.total,
+        cycle.ready,
+        cycle.waiting,
+        cycle.crank,
+        cycle.build,
+        cycle.review_start,
+        cycle.review,
+        cycle.regression_testing,
+        cycle.verification_testing,
+        cycle.certification_testing,
+        cycle.crank_complete,
+        cycle.build_to_boot,
+        cycle.boot_testing,
+        cycle.sru_review,
+        cycle.new_review,
+        cycle.to_proposed,
+        cycle.regression,
+        cycle.automated_testing,
+    )
+
+# The durations kept in sru_cycle_stats. Each is the time between two of a bug's task
+# status changes: (column, end task, end date, start task, start date). A duration is
+# 0 when either task is missing or either date is 0 (not happened / not known). The
+# same list drives db-update's update_stats (one bug at a time, as they are ingested)
+# and BugzDB.rebuild_sru_cycle_stats (every bug at once, in sql).
+#
+SRUCycleStages = [
+    ('total',                 'promote-to-updates',    'date_fix_released',  'prepare-package',       'date_in_progress'  ),
+    ('ready',                 'prepare-package',       'date_confirmed',     'prepare-package',       'date_created'      ),
+    ('waiting',               'prepare-package',       'date_in_progress',   'prepare-package',       'date_confirmed'    ),
+    ('crank',                 'prepare-package',       'date_fix_committed', 'prepare-package',       'date_in_progress'  ),
+    ('build',                 'promote-to-proposed',   'date_confirmed',     'prepare-package',       'date_fix_committed'),
+    ('review_start',          'promote-to-proposed',   'date_in_progress',   'promote-to-proposed',   'date_confirmed'    ),
+    ('review',                'promote-to-proposed',   'date_fix_committed', 'promote-to-proposed',   'date_in_progress'  ),
+    ('regression_testing',    'regression-testing',    'date_fix_released',  'regression-testing',    'date_confirmed'    ),
+    ('certification_testing', 'certification-testing', 'date_fix_released',  'certification-testing', 'date_confirmed'    ),
+    ('verification_testing',  'verification-testing',  'date_fix_released',  'verification-testing',  'date_confirmed'    ),
+
+    # The stages as the stats tool shows them
+    #
+    ('crank_complete',        'prepare-package',       'date_fix_released',  'prepare-package',       'date_in_progress'  ),
+    ('build_to_boot',         'boot-testing',          'date_triaged',       'prepare-package',       'date_fix_committed'),
+    ('boot_testing',          'boot-testing',          'date_fix_released',  'boot-testing',          'date_triaged'      ),
+    ('sru_review',            'sru-review',            'date_fix_released',  'sru-review',            'date_confirmed'    ),
+    ('new_review',            'new-review',            'date_fix_released',  'new-review',            'date_confirmed'    ),
+    ('to_proposed',           'promote-to-proposed',   'date_fix_released',  'prepare-package',       'date_in_progress'  ),
+    ('regression',            'regression-testing',    'date_fix_released',  'regression-testing',    'date_incomplete'   ),
+    ('automated_testing',     'automated-testing',     'date_fix_released',  'automated-testing',     'date_incomplete'   ),
+]
+
+def stage_dates_pivot(stages):
+    '''
+    The sql which pivots the task dates the stages (entries of SRUCycleStages) need
+    out of bug_tasks (as "t", grouped by bug) into one column each, named d0, d1, ...
+    A missing task comes out as 0, just like a missing date. Returns the sql, its
+    parameters and, for each stage, the names of its end and start date columns.
+    '''
+    dates = []
+    for column, end_task, end_date, start_task, start_date in stages:
+        for date in ((end_task, end_date), (start_task, start_date)):
+            if date not in dates:
+                dates.append(date)
+    pivot  = ', '.join('coalesce(max(case when t.task_name = ? then t.%s end), 0) as d%d' % (date, n) for n, (task, date) in enumerate(dates))
+    params = [task for task, date in dates]
+    edges  = [('d%d' % dates.index((stage[1], stage[2])), 'd%d' % dates.index((stage[3], stage[4]))) for stage in stages]
+    return pivot, params, edges
+
+def rollup_durations(rec):
+    '''
+    What an sru_cycle_stats record (anything indexed by column name) contributes to
+    cycle_rollups: ((cycle, series, stage), duration) for each of its stages with a
+    duration. Only the debs are rolled up, as only they are shown by stats.
+    '''
+    if rec['variant'] != 'debs':
+        return
+    for stage in SRUCycleStages:
+        duration = rec[stage[0]]
+        if duration and duration > 0:
+            yield (rec['cycle'], rec['series'], stage[0]), duration
+
 class BugzDB(SQLBase):
 
-    def __init__(self):
-        self.db_path = '/'.join([os.path.expanduser('~'), '.cache', 'bugz', 'bugz.db'])
-        SQLBase.__init__(self, self.db_path)
-        self.sql = sqlite3.connect(self.db_path)
-        self.sql.row_factory = sqlite3.Row
+    # The statements used to write bugs, their tags and tasks and their stats. The
+    # values for them come from the *_row(s) functions below.
+    #
+    insert_bug_q  = 'insert or replace into bugs (id, title, owner, owner_display_name, created, last_message, last_updated, private, security, duplicate, heat, '
+    insert_bug_q += 'is_expirable, problem_type, description, master_bug_id, cycle, spin, series, package, version, variant) '
+    insert_bug_q += 'values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);'
+
+    delete_tags_q = 'delete from tags where id = ?;'
+    insert_tag_q  = 'insert into tags (id, tag) values (?, ?);'
+
+    delete_tasks_q = 'delete from bug_tasks where bug_id = ?;'
+    insert_task_q  = 'insert or replace into bug_tasks (bug_id, task_name, assignee, status, importance, date_created, date_confirmed, date_assigned, date_closed, '
+    insert_task_q += 'date_fix_committed, date_fix_released, date_in_progress, date_incomplete, date_left_closed, date_left_new, date_triaged, is_complete, owner, '
+    insert_task_q += 'title, milestone) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);'
+
+    insert_sru_cycle_stats_q  = 'insert or replace into sru_cycle_stats (id, series, package, cycle, variant, total, ready, waiting, crank, build, review_start, '
+    insert_sru_cycle_stats_q += 'review, regression_testing, verification_testing, certification_testing, crank_complete, build_to_boot, boot_testing, sru_review, '
+    insert_sru_cycle_stats_q += 'new_review, to_proposed, regression, automated_testing) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);'
+
+    insert_cycle_rollup_q = 'insert or replace into cycle_rollups (cycle, series, stage, count, sum, min, max, sketch) values (?, ?, ?, ?, ?, ?, ?, ?);'
+    delete_cycle_rollup_q = 'delete from cycle_rollups where cycle = ? and series = ? and stage = ?;'
+
+    insert_cache_import_q = 'insert or replace into cache_imports (path, mtime, size) values (?, ?, ?);'
+
+    insert_task_activity_q = 'insert or ignore into task_activity (bug_id, task, old_status, new_status, changed_at, who) values (?, ?, ?, ?, ?, ?);'
+    insert_activity_mark_q = 'insert or replace into activity_marks (bug_id, count, latest) values (?, ?, ?);'
+
+    # The sru_cycle_stats columns (the stats tool's stages) that were added after the
+    # table was first created.
+    #
+    added_sru_cycle_stats_columns = ['crank_complete', 'build_to_boot', 'boot_testing', 'sru_review', 'new_review', 'to_proposed', 'regression', 'automated_testing']
+
+    # The indexes that the frequent queries (mostly BugHelper's) rely on. Each is the
+    # index name, the table and the indexed columns.
+    #
+    indexes = [
+        ('bugs_cycle_series',            'bugs',            'cycle, series, variant, package, id'),
+        ('tags_id',                      'tags',            'id, tag'),
+        ('bug_tasks_task_name',          'bug_tasks',       'task_name'),
+        ('sru_cycle_stats_cycle_series', 'sru_cycle_stats', 'cycle, series, variant, package'),
+        ('task_activity_task',           'task_activity',   'task, new_status'),
+    ]
+
+    def __init__(self, sql=None):
+        # BUGZ_DB in the environment points the tools at a different database, e.g.
+        # one made by "benchmark generate".
+        #
+        self.db_path = os.environ.get('BUGZ_DB') or '/'.join([os.path.expanduser('~'), '.cache', 'bugz', 'bugz.db'])
+        SQLBase.__init__(self, self.db_path, sql)
+
+    @contextmanager
+    def writer_lock(self):
+        '''
+        An advisory lock, held for the duration of the scope, which makes processes that
+        update the database take turns rather than interleave their writes. Readers
+        don't need it.
+        '''
+        with open(self.db_path + '.lock', 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                print('Waiting for another update of %s to finish.' % self.db_path, file=sys.stderr)
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
 
     def init_schema_sru_cycle_stats_table(self):
         try:
@@ -67,44 +419,193 @@ class BugzDB(SQLBase):
             q += '    review                integer,'            # promote-to-proposed(fix committed)  - promote-to-proposed(in progress)
             q += '    regression_testing    integer,'            # regression-testing(fix released)    - regression-testing(confirmed)
             q += '    verification_testing  integer,'            # verification-testing(fix released)  - verification-testing(confirmed)
-            q += '    certification_testing integer'             # certification-testing(fix released) - certification-testing(confirmed)
+            q += '    certification_testing integer,'            # certification-testing(fix released) - certification-testing(confirmed)
+            q += '    crank_complete        integer,'            # prepare-package(fix released)       - prepare-package(in progress)
+            q += '    build_to_boot         integer,'            # boot-testing(triaged)               - prepare-package(fix committed)
+            q += '    boot_testing          integer,'            # boot-testing(fix released)          - boot-testing(triaged)
+            q += '    sru_review            integer,'            # sru-review(fix released)            - sru-review(confirmed)
+            q += '    new_review            integer,'            # new-review(fix released)            - new-review(confirmed)
+            q += '    to_proposed           integer,'            # promote-to-proposed(fix released)   - prepare-package(in progress)
+            q += '    regression            integer,'            # regression-testing(fix released)    - regression-testing(incomplete)
+            q += '    automated_testing     integer'             # automated-testing(fix released)     - automated-testing(incomplete)
             q += ');'
 
             cursor.execute(q)
-            self.sql.commit()
+
+            # Databases created before the stats tool's stages were stored get the
+            # columns added. They are filled in by "db-update sru-cycle-stats".
+            #
+            for column in self.missing_sru_cycle_stats_columns():
+                cursor.execute('alter table sru_cycle_stats add column %s integer default 0;' % column)
+            self.complete()
         except Exception as e:
             self.sql.rollback()
-            self.sql.close()
             raise e
 
-    def update_sru_cycle_stats_table(self, cycle):
-        cursor = self.sql.cursor()
+    def has_table(self, name):
+        return self.fetch_one('select name from sqlite_master where type = \'table\' and name = ?;', (name,)) is not None
 
-        q  = 'insert or replace into sru_cycle_stats (id, series, package, cycle, variant, total, ready, waiting, crank, build, review_start, review, regression_testing, verification_testing, certification_testing) values '
-        q += '('
-        q += '"{}",'.format(cycle.id)
-        q += '"{}",'.format(cycle.series)
-        q += '"{}",'.format(cycle.package)
-        q += '"{}",'.format(cycle.cycle)
-        q += '"{}",'.format(cycle.variant)
-        q += '"{}",'.format(cycle.total)
-        q += '"{}",'.format(cycle.ready)
-        q += '"{}",'.format(cycle.waiting)
-        q += '"{}",'.format(cycle.crank)
-        q += '"{}",'.format(cycle.build)
-        q += '"{}",'.format(cycle.review_start)
-        q += '"{}",'.format(cycle.review)
-        q += '"{}",'.format(cycle.regression_testing)
-        q += '"{}",'.format(cycle.verification_testing)
-        q += '"{}"'.format(cycle.certification_testing)
-        q += ');'
+    def missing_sru_cycle_stats_columns(self):
+        present = [rec['name'] for rec in self.fetch_all('pragma table_info(sru_cycle_stats);')]
+        return [column for column in self.added_sru_cycle_stats_columns if column not in present]
+
+    def update_sru_cycle_stats_table(self, cycle):
         try:
-            cursor.execute(q)
-            self.sql.commit()
+            with self.transaction():
+                row = sru_cycle_stats_row(cycle)
+                changes = self.cycle_rollup_changes([row])
+                self.query(self.insert_sru_cycle_stats_q, row)
+                self.update_cycle_rollups(changes)
         except sqlite3.OperationalError:
-            print('Exception thrown executing:\n    %s\n' % q)
+            print('Exception thrown executing:\n    %s\n' % self.insert_sru_cycle_stats_q)
             raise
 
+    def init_schema_cycle_rollups_table(self):
+        '''
+        The cycle_rollups table: for each cycle, series and stage (sru_cycle_stats
+        column) the count, sum, min and max of the debs' durations along with a quantile
+        sketch of them. It's kept up to date as sru_cycle_stats records are written (see
+        update_cycle_rollups) so that trends across cycles don't need every bug. When
+        the table is added to a database that already has stats it's filled in from them.
+        '''
+        exists = self.has_table('cycle_rollups')
+
+        q  = 'create table if not exists '
+        q += 'cycle_rollups ( '
+        q += '    cycle                 text,'               # The SRU cycle id (without the spin #)
+        q += '    series                text,'               # Series
+        q += '    stage                 text,'               # The sru_cycle_stats column
+        q += '    count                 integer,'            # The number of bugs with a duration for the stage
+        q += '    sum                   integer,'            # The total of their durations
+        q += '    min                   integer,'
+        q += '    max                   integer,'
+        q += '    sketch                text,'               # lib.sketch.QuantileSketch state (json)
+        q += '    primary key (cycle, series, stage)'
+        q += ');'
+        self.commit(q)
+
+        if exists is None and self.fetch_one('select id from sru_cycle_stats limit 1;') is not None:
+            self.rebuild_cycle_rollups()
+
+    def rollup_sketches(self, keys):
+        '''
+        The sketches of the cycle_rollups records with the given (cycle, series, stage)
+        keys, empty ones for those there's no record of yet.
+        '''
+        sketches = {key: QuantileSketch() for key in keys}
+        for cycle, series in set(key[:2] for key in keys):
+            for rec in self.fetch_all('select stage, sketch from cycle_rollups where cycle = ? and series = ?;', (cycle, series)):
+                key = (cycle, series, rec['stage'])
+                if key in sketches:
+                    sketches[key] = QuantileSketch.loads(rec['sketch'])
+        return sketches
+
+    def write_rollups(self, sketches):
+        cursor = self.sql.cursor()
+        cursor.executemany(self.delete_cycle_rollup_q, [key for key, sketch in sketches.items() if sketch.count == 0])
+        cursor.executemany(self.insert_cycle_rollup_q, [key + (sketch.count, sketch.sum, sketch.min, sketch.max, sketch.dumps()) for key, sketch in sketches.items() if sketch.count])
+
+    def cycle_rollup_changes(self, rows):
+        '''
+        How cycle_rollups has to change for the sru_cycle_stats rows (sru_cycle_stats_row())
+        that are about to be written: the durations of the records they replace come out
+        and theirs go in. It has to be called before the rows are written and the changes
+        passed to update_cycle_rollups, in the same transaction, once they have been.
+        '''
+        changes = {}                    # (cycle, series, stage): {duration: +n / -n}
+        ids = [row[0] for row in rows]
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            q = 'select * from sru_cycle_stats where id in (%s);' % ', '.join('?' * len(chunk))
+            for rec in self.fetch_all(q, chunk):
+                for key, duration in rollup_durations(rec):
+                    change = changes.setdefault(key, {})
+                    change[duration] = change.get(duration, 0) - 1
+        for row in rows:
+            for key, duration in rollup_durations(dict(zip(sru_cycle_stats_columns, row))):
+                change = changes.setdefault(key, {})
+                change[duration] = change.get(duration, 0) + 1
+
+        # A bug that's stored again with the same stats doesn't change anything.
+        #
+        changes = {key: {duration: n for duration, n in change.items() if n} for key, change in changes.items()}
+        return {key: change for key, change in changes.items() if change}
+
+    def update_cycle_rollups(self, changes):
+        '''
+        Apply the cycle_rollup_changes() to the rollups they affect, the only ones read
+        and written.
+        '''
+        if not changes:
+            return
+
+        sketches = self.rollup_sketches(list(changes))
+        for key, change in changes.items():
+            sketch = sketches[key]
+            extremes = (sketch.min, sketch.max)
+            for duration, n in change.items():
+                if n > 0:
+                    sketch.add(duration, n)
+                else:
+                    sketch.remove(duration, -n)
+
+            # A sketch only knows roughly what the min or max is once the value that was
+            # it has gone, the exact one comes from the (indexed) cycle and series.
+            #
+            if sketch.count and any(n < 0 and duration in extremes for duration, n in change.items()):
+                cycle, series, stage = key
+                q  = 'select min(%s) as min, max(%s) as max from sru_cycle_stats ' % (stage, stage)
+                q += 'where cycle = ? and series = ? and variant = \'debs\' and %s > 0;' % stage
+                rec = self.fetch_one(q, (cycle, series))
+                sketch.min, sketch.max = rec['min'], rec['max']
+        self.write_rollups(sketches)
+
+    def rebuild_cycle_rollups(self):
+        '''
+        Recompute all of cycle_rollups from sru_cycle_stats. Only needed when the stats
+        have been written without going through update_cycle_rollups, like
+        rebuild_sru_cycle_stats does.
+        '''
+        sketches = {}
+        with self.transaction():
+            for rec in self.query('select * from sru_cycle_stats where variant = \'debs\';'):
+                for key, duration in rollup_durations(rec):
+                    sketch = sketches.get(key)
+                    if sketch is None:
+                        sketch = sketches[key] = QuantileSketch()
+                    sketch.add(duration)
+            self.query('delete from cycle_rollups;')
+            self.write_rollups(sketches)
+        return len(sketches)
+
+    def rebuild_sru_cycle_stats(self):
+        '''
+        Recompute the sru_cycle_stats of every debs bug with a cycle, and of every bug
+        which already has stats (devel cycles and snaps included), straight from the
+        bug_tasks table with a single insert ... select, rather than loading each bug
+        and computing its stats in python. The results are the same as update_stats
+        produces (see SRUCycleStages). Returns the number of bugs whose stats were
+        written.
+        '''
+        pivot, params, edges = stage_dates_pivot(SRUCycleStages)
+        deltas = ['case when %s = 0 or %s = 0 then 0 else %s - %s end' % (end, start, end, start) for end, start in edges]
+
+        q  = 'insert or replace into sru_cycle_stats (id, series, package, cycle, variant, %s) ' % ', '.join(stage[0] for stage in SRUCycleStages)
+        q += 'select id, series, package, cycle, variant, %s from (' % ', '.join(deltas)
+        q += '    select b.id, b.series, b.package, b.cycle, b.variant, %s ' % pivot
+        q += '    from bugs as b left join bug_tasks as t on t.bug_id = b.id '
+        q += '    where (b.cycle is not null and b.cycle not in (\'\', \'None\') and b.variant = \'debs\') '
+        q += '       or b.id in (select id from sru_cycle_stats) '     # Whatever "stats" shows gets the new columns
+        q += '    group by b.id'
+        q += ');'
+
+        with self.transaction():
+            cursor = self.sql.cursor()
+            cursor.execute(q, params)
+            count = cursor.rowcount
+            self.rebuild_cycle_rollups()
+            return count
+
     def init_schema_bug_table(self):
         try:
             cursor = self.sql.cursor()
@@ -134,58 +635,23 @@ class BugzDB(SQLBase):
             q += '    variant               text'                # variant
             q += ');'
             cursor.execute(q)
-            self.sql.commit()
-        except Exception as e:
-            self.sql.rollback()
-            self.sql.close()
-            raise e
-
-    def init_schema_tasks_table(self):
-        try:
-            # This table is for mapping from bugs to tables that are specific
-            # to an individual task
-            #
-            cursor = self.sql.cursor()
-
-            q  = 'create table if not exists '
-            q += 'tasks ( '
-            q += '    id                    text key,'           # lpbug.id
-            q += '    tbl                   text'                # table name
-            q += ');'
-            cursor.execute(q)
-            self.sql.commit()
+            self.complete()
         except Exception as e:
             self.sql.rollback()
-            self.sql.close()
             raise e
 
+    def init_schema_bug_tasks_table(self):
         try:
-            # This table maps from a LP task name to the corresponding table
-            # for that task.
+            # One row per task of each bug. This replaces the table per task
+            # (and the tasks/task_names tables which mapped bugs to them) that
+            # used to be created on the fly as new tasks showed up.
             #
             cursor = self.sql.cursor()
 
             q  = 'create table if not exists '
-            q += 'task_names ( '
-            # q += '    id                    text key,'           # lpbug.id
-            q += '    tbl                   text,'               # table name
-            q += '    name                  text'                # task name
-            q += ');'
-            cursor.execute(q)
-            self.sql.commit()
-        except Exception as e:
-            self.sql.rollback()
-            self.sql.close()
-            raise e
-
-    def init_schema_task_table(self, table):
-        try:
-            cursor = self.sql.cursor()
-
-            q  = 'create table if not exists '
-            q += '%s ( ' % table
-            q += '    rid                   integer primary key autoincrement,'
-            q += '    id                    text key,'           # lpbug.id
+            q += 'bug_tasks ( '
+            q += '    bug_id                text,'               # lpbug.id
+            q += '    task_name             text,'               # task name without the "kernel-sru-workflow/" prefix
 
             q += '    assignee              text,'               # assignee.display_name
             q += '    status                text,'               # task.status
@@ -205,15 +671,16 @@ class BugzDB(SQLBase):
             q += '    owner                 text,'               # task.owner.display_name
             q += '    title                 text,'               # task.title
             q += '    milestone             text,'               # task.milestone
-            q += '    name                  text'                # task.bug_target_display_name
 
+            q += '    primary key (bug_id, task_name)'
             q += ');'
             cursor.execute(q)
-            self.sql.commit()
+
+            q = 'create index if not exists bug_tasks_task_name on bug_tasks (task_name);'
+            cursor.execute(q)
+            self.complete()
         except Exception as e:
-            print(q)
             self.sql.rollback()
-            self.sql.close()
             raise e
 
     def init_schema_comments_table(self):
@@ -232,10 +699,9 @@ class BugzDB(SQLBase):
 
             q += ');'
             cursor.execute(q)
-            self.sql.commit()
+            self.complete()
         except Exception as e:
             self.sql.rollback()
-            self.sql.close()
             raise e
 
     def init_schema_nominations_table(self):
@@ -257,10 +723,9 @@ class BugzDB(SQLBase):
 
             q += ');'
             cursor.execute(q)
-            self.sql.commit()
+            self.complete()
         except Exception as e:
             self.sql.rollback()
-            self.sql.close()
             raise e
 
     def init_schema_tags_table(self):
@@ -273,170 +738,267 @@ class BugzDB(SQLBase):
             q += '    tag                   text'                # a single tag associated with the bug
             q += ');'
             cursor.execute(q)
-            self.sql.commit()
+            self.complete()
         except Exception as e:
             self.sql.rollback()
-            self.sql.close()
             raise e
 
+    def init_schema_task_activity_table(self):
+        # Every task status change in the bugs' histories. Rows are only ever added, a
+        # change that's already there (same bug, task, time and statuses) is ignored, so
+        # ingesting a bug again just adds what's new. The unique key also serves lookups
+        # by bug and by bug and task.
+        #
+        q  = 'create table if not exists '
+        q += 'task_activity ( '
+        q += '    bug_id                text,'               # lpbug.id
+        q += '    task                  text,'               # The task name (without kernel-sru-workflow/)
+        q += '    old_status            text,'
+        q += '    new_status            text,'
+        q += '    changed_at            integer,'            # timestamp() of when it changed
+        q += '    who                   text,'               # The name of the person (or bot) who changed it
+        q += '    unique (bug_id, task, changed_at, old_status, new_status)'
+        q += ');'
+        self.commit(q)
+
+    def init_schema_activity_marks_table(self):
+        # How much of each bug's Launchpad activity has been ingested, so that ingesting
+        # it again only needs to fetch what's been added since (see Bug.activity_since).
+        #
+        q  = 'create table if not exists '
+        q += 'activity_marks ( '
+        q += '    bug_id                text primary key,'   # lpbug.id
+        q += '    count                 integer,'            # The number of activity entries ingested
+        q += '    latest                integer'             # timestamp() of the last of them
+        q += ');'
+        self.commit(q)
+
+    def init_schema_cache_imports_table(self):
+        # The tracking bugs cache files "db-update import-cache" has imported, as they
+        # were when it did, so that those that haven't changed since can be skipped.
+        #
+        q  = 'create table if not exists '
+        q += 'cache_imports ( '
+        q += '    path                  text primary key,'   # The YAML file
+        q += '    mtime                 integer,'            # Its st_mtime_ns
+        q += '    size                  integer'             # and st_size when it was imported
+        q += ');'
+        self.commit(q)
+
+    def cache_imports(self):
+        '''
+        The files "db-update import-cache" has imported as {path: (mtime, size)}.
+        '''
+        self.init_schema_cache_imports_table()
+        return {rec['path']: (rec['mtime'], rec['size']) for rec in self.fetch_all('select * from cache_imports;')}
+
+    def init_schema_meta_table(self):
+        # Odds and ends that need to be remembered from one run to the next, such as
+        # high-water marks.
+        #
+        q  = 'create table if not exists '
+        q += 'meta ( '
+        q += '    key                   text primary key,'
+        q += '    value                 text'
+        q += ');'
+        self.commit(q)
+
+    def get_meta(self, key, default=None):
+        self.init_schema_meta_table()
+        rec = self.fetch_one('select value from meta where key = ?;', (key,))
+        return default if rec is None else rec['value']
+
+    def set_meta(self, key, value):
+        self.init_schema_meta_table()
+        self.commit('insert or replace into meta (key, value) values (?, ?);', (key, str(value)))
+
     def init_schema(self):
         self.init_schema_bug_table()
-        self.init_schema_tasks_table()
+        self.init_schema_bug_tasks_table()
         self.init_schema_comments_table()
         self.init_schema_nominations_table()
         self.init_schema_tags_table()
         self.init_schema_sru_cycle_stats_table()
+        self.init_schema_cycle_rollups_table()
+        self.init_schema_task_activity_table()
+        self.init_schema_activity_marks_table()
+        self.init_schema_cache_imports_table()
+        self.init_schema_meta_table()
+        self.init_schema_indexes()
+
+    def init_schema_indexes(self):
+        for name, table, columns in self.indexes:
+            self.query('create index if not exists %s on %s (%s);' % (name, table, columns))
+        self.complete()
+
+    def missing_indexes(self):
+        q = 'select name from sqlite_master where type = "index";'
+        present = [rec['name'] for rec in self.fetch_all(q)]
+        return [index for index in self.indexes if index[0] not in present]
+
+    def analyze(self):
+        self.query('analyze;')
+        self.complete()
+
+    def vacuum(self):
+        # VACUUM can't be run inside a transaction.
+        #
+        self.sql.commit()
+        self.query('vacuum;')
+
+    def object_sizes(self):
+        '''
+        The tables and indexes in the database along with their type, the number of rows
+        (tables only) and the space they take up on disk in bytes. The size is None if
+        this sqlite was built without the dbstat virtual table.
+        '''
+        sizes = {}
+        try:
+            q = 'select name, sum(pgsize) as size from dbstat group by name;'
+            for rec in self.fetch_all(q):
+                sizes[rec['name']] = rec['size']
+        except sqlite3.OperationalError:
+            pass
+
+        results = []
+        q = 'select name, type from sqlite_master where type in ("table", "index") and name not like "sqlite_%" order by type desc, name;'
+        for rec in self.fetch_all(q):
+            rows = None
+            if rec['type'] == 'table':
+                rows = self.fetch_one('select count(*) as n from %s;' % rec['name'])['n']
+            results.append((rec['name'], rec['type'], rows, sizes.get(rec['name'])))
+        return results
 
-    def text_clean(self, text):
-        return text.replace('"', '""')
+    def query_plan(self, query, params=()):
+        return [rec['detail'] for rec in self.fetch_all('explain query plan ' + query, params)]
 
     def update_bugs_table(self, bug):
         cursor = self.sql.cursor()
-        q  = 'insert or replace into bugs (id, title, owner, owner_display_name, created, last_message, last_updated, private, security, duplicate, heat, is_expirable, problem_type, description, master_bug_id, cycle, spin, series, package, version, variant) values '
-        q += '('
-        q += '"{}",'.format(bug.id)
-        q += '"{}",'.format(bug.title)
-        q += '"{}",'.format(bug.owner)
-        q += '"{}",'.format(bug.owner_display_name)
-        q += '"{}",'.format(bug.created)
-        q += '"{}",'.format(bug.last_message)
-        q += '"{}",'.format(bug.last_updated)
-        q += '"{}",'.format(bug.private)
-        q += '"{}",'.format(bug.security)
-        q += '"{}",'.format(bug.duplicate)
-        q += '"{}",'.format(bug.heat)
-        q += '"{}",'.format(bug.is_expirable)
-        q += '"{}",'.format(bug.problem_type)
-        q += '"{}",'.format(self.text_clean(bug.description))
-        q += '"{}",'.format(bug.master_bug_id)
-        q += '"{}",'.format(bug.cycle)
-        q += '"{}",'.format(bug.spin)
-        q += '"{}",'.format(bug.series)
-        q += '"{}",'.format(bug.package)
-        q += '"{}",'.format(bug.version)
-        q += '"{}"'.format(bug.variant)
-        q += ');'
         try:
-            cursor.execute(q)
+            cursor.execute(self.insert_bug_q, bug_row(bug))
         except sqlite3.OperationalError:
-            print('Exception thrown executing:\n    %s\n' % q)
+            print('Exception thrown executing:\n    %s\n' % self.insert_bug_q)
             raise
 
-        self.sql.commit()
-
-        q = 'delete from tags where id = %s;' % bug.id
-        cursor.execute(q)
-
-        for tag in bug.tags:
-            q  = 'insert into tags ('
-            q += 'id, '
-            q += 'tag '
-            q += ') values ('
-            q += '"{}", '.format(bug.id)
-            q += '"%s"' % tag
-            q += ');'
-            try:
-                cursor.execute(q)
-            except sqlite3.OperationalError:
-                print('Exception thrown executing:\n    %s\n' % q)
-                raise
-
-        self.sql.commit()
+        cursor.execute(self.delete_tags_q, (str(bug.id),))
+        cursor.executemany(self.insert_tag_q, tag_rows(bug))
+        self.complete()
 
     def update_tasks_tables(self, bug):
         cursor = self.sql.cursor()
 
-        # We need to first remove any existing mappings from the bug id to
-        # tasks associated to that bug.
+        # Any tasks that the bug used to have but no longer does must go as well.
         #
-        q = 'delete from tasks where id = %s;' % bug.id
-        cursor.execute(q)
-
-        for taskname in bug.tasks:
-            task = bug.tasks[taskname]
-            # print(json.dumps(task, sort_keys=True, indent=4))
-            table = taskname.replace('-', '_').replace(' ', '_').replace('(', '').replace(')', '').replace('/', '___').replace('.', '_')
-
-            # By always creating the table if it doesn't exist when we add new tasks to the bugs we don't
-            # have to come in here and add additional code to create the schema.
-            #
-            self.init_schema_task_table(table)
-
-            q = 'delete from %s where id = %s;' % (table, bug.id)
-            cursor.execute(q)
-
-            q  = 'insert or replace into %s (' % table
-            q += 'id, '
-            q += 'assignee,'
-            q += 'status,'
-            q += 'importance,'
-            q += 'date_created,'
-            q += 'date_confirmed,'
-            q += 'date_assigned,'
-            q += 'date_closed,'
-            q += 'date_fix_committed,'
-            q += 'date_fix_released,'
-            q += 'date_in_progress,'
-            q += 'date_incomplete,'
-            q += 'date_left_closed,'
-            q += 'date_left_new,'
-            q += 'date_triaged,'
-            q += 'is_complete,'
-            q += 'owner,'
-            q += 'title,'
-            q += 'milestone,'
-            q += 'name'
-            q += ') values (' # % table
-            q += '"{}", '.format(bug.id)
-            q += '"{}", '.format(task.assignee)
-            q += '"{}", '.format(task.status)
-            q += '"{}", '.format(task.importance)
-            q += '"{}", '.format(task.date_created)
-            q += '"{}", '.format(task.date_confirmed)
-            q += '"{}", '.format(task.date_assigned)
-            q += '"{}", '.format(task.date_closed)
-            q += '"{}", '.format(task.date_fix_committed)
-            q += '"{}", '.format(task.date_fix_released)
-            q += '"{}", '.format(task.date_in_progress)
-            q += '"{}", '.format(task.date_incomplete)
-            q += '"{}", '.format(task.date_left_closed)
-            q += '"{}", '.format(task.date_left_new)
-            q += '"{}", '.format(task.date_triaged)
-            q += '"{}", '.format(task.is_complete)
-            q += '"{}", '.format(task.owner)
-            q += '"{}", '.format(self.text_clean(task.title))
-            q += '"{}", '.format(task.milestone)
-            q += '"{}"'.format(taskname)
-            q += ');'
-
-            cursor.execute(q)
-
-            # This maps a single bug to all of the task tables that it has information in.
-            #
-            q  = 'insert into tasks(id, tbl) values'
-            q += '('
-            q += '"{}", '.format(bug.id)
-            q += '"{}"  '.format(table)
-            q += ');'
-            cursor.execute(q)
-
-            # This maps all of the tasks names to their table.
-            #
-            # q  = 'insert or ignore into task_names(id, tbl, name) values '
-            q  = 'insert or ignore into task_names(tbl, name) values '
-            q += '('
-            # q += '(select id from task_names where tbl = "%s" and name = "%s"), ' % (table, taskname)
-            q += '"{}", '.format(table)
-            q += '"{}"  '.format(taskname)
-            q += ');'
-            cursor.execute(q)
-
-            self.sql.commit()
-
-            # if table not in self.sql_tables:
-            #     self.sql_tables.append(table)
+        cursor.execute(self.delete_tasks_q, (str(bug.id),))
+        cursor.executemany(self.insert_task_q, task_rows(bug))
+        cursor.executemany(self.insert_task_activity_q, task_activity_rows(bug))
+        cursor.executemany(self.insert_activity_mark_q, activity_mark_rows(bug))
+        self.complete()
+
+    def migrate_tasks_tables(self, drop=False):
+        '''
+        Fold the old per-task tables (found through the tasks and task_names mapping
+        tables) into the bug_tasks table. When drop is True the old tables are removed
+        once their contents have been copied. Returns the number of task rows copied.
+        '''
+        self.init_schema_bug_tasks_table()
+
+        q = 'select name from sqlite_master where type = "table" and name in ("tasks", "task_names");'
+        old = [rec['name'] for rec in self.fetch_all(q)]
+        if 'tasks' not in old:
+            return 0
+
+        q = 'select distinct tbl from tasks where tbl in (select name from sqlite_master where type = "table");'
+        tables = [rec['tbl'] for rec in self.fetch_all(q)]
+
+        copied = 0
+        cursor = self.sql.cursor()
+        with self.transaction():
+            for table in tables:
+                # Only the bugs that the tasks table maps to this table are copied, the same
+                # ones Bug.load used to read. Rows are copied in the order they were added
+                # so that the most recent one wins.
+                #
+                q  = 'insert or replace into bug_tasks ('
+                q += 'bug_id, task_name, assignee, status, importance, date_created, date_confirmed, date_assigned, date_closed, '
+                q += 'date_fix_committed, date_fix_released, date_in_progress, date_incomplete, date_left_closed, date_left_new, '
+                q += 'date_triaged, is_complete, owner, title, milestone'
+                q += ') select '
+                q += 'id, replace(name, "kernel-sru-workflow/", ""), assignee, status, importance, date_created, date_confirmed, date_assigned, date_closed, '
+                q += 'date_fix_committed, date_fix_released, date_in_progress, date_incomplete, date_left_closed, date_left_new, '
+                q += 'date_triaged, is_complete, owner, title, milestone '
+                q += 'from %s where id in (select id from tasks where tbl = ?) order by rid;' % table
+                cursor.execute(q, (table,))
+                copied += cursor.rowcount
+
+            if drop:
+                for table in tables + old:
+                    cursor.execute('drop table if exists %s;' % table)
+
+        return copied
 
     def load_new_bug(self, msg):
-        msg['title'] = msg['title'].replace('"', '""')
         self.update_bugs_table(msg)
         self.update_tasks_tables(msg)
+
+class BugzWriter(BugzDB):
+    '''
+    Stages bugs (with their tags and tasks) and sru_cycle_stats records and writes them
+    out with executemany, one transaction per batch, rather than a handful of commits
+    for every bug. Once batch bugs or stats records are staged they are flushed; flush()
+    must be called once everything has been staged to write out the remainder. The
+    tracking bugs cache files the bugs were imported from are recorded along with them.
+    '''
+    def __init__(self, batch=500, sql=None):
+        BugzDB.__init__(self, sql)
+        self.batch = batch
+        self.bugs = {}
+        self.stats = {}
+        self.imports = {}
+
+    def stage_bug(self, bug):
+        self.bugs[str(bug.id)] = (bug_row(bug), tag_rows(bug), task_rows(bug), task_activity_rows(bug), activity_mark_rows(bug))
+        if len(self.bugs) >= self.batch:
+            self.flush()
+
+    def stage_stats(self, cycle):
+        self.stats[str(cycle.id)] = sru_cycle_stats_row(cycle)
+        if len(self.stats) >= self.batch:
+            self.flush()
+
+    def stage_import(self, path, stamp):
+        '''
+        Record that the cache file at path, with stamp (its st_mtime_ns and st_size),
+        has been imported once what's been staged for it is written.
+        '''
+        self.imports[path] = (path,) + tuple(stamp)
+
+    def flush(self):
+        if not self.bugs and not self.stats and not self.imports:
+            return
+
+        ids  = [(bid,) for bid in self.bugs]
+        bugs = [staged[0] for staged in self.bugs.values()]
+        tags = [tag for staged in self.bugs.values() for tag in staged[1]]
+        tasks = [task for staged in self.bugs.values() for task in staged[2]]
+        activity = [change for staged in self.bugs.values() for change in staged[3]]
+        marks = [mark for staged in self.bugs.values() for mark in staged[4]]
+
+        with self.transaction():
+            cursor = self.sql.cursor()
+            cursor.executemany(self.insert_bug_q, bugs)
+            cursor.executemany(self.delete_tags_q, ids)
+            cursor.executemany(self.insert_tag_q, tags)
+            cursor.executemany(self.delete_tasks_q, ids)
+            cursor.executemany(self.insert_task_q, tasks)
+            cursor.executemany(self.insert_task_activity_q, activity)
+            cursor.executemany(self.insert_activity_mark_q, marks)
+            changes = self.cycle_rollup_changes(list(self.stats.values()))
+            cursor.executemany(self.insert_sru_cycle_stats_q, list(self.stats.values()))
+            self.update_cycle_rollups(changes)
+            if self.imports:
+                cursor.executemany(self.insert_cache_import_q, list(self.imports.values()))
+
+        self.bugs = {}
+        self.stats = {}
+        self.imports = {}
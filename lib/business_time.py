@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+#
+# Business time: how much of an interval falls on working days. The timestamps are the
+# ones stored in the bugz database, seconds since the epoch below, which was a Monday.
+# Weekends are Saturday and Sunday (UTC). Holidays are whole days (UTC) that are also
+# taken out of an interval when they fall on a weekday.
+#
+# Rather than stepping through an interval a day at a time, the business time between
+# the epoch and a timestamp is worked out in closed form (whole weeks contribute five
+# days each, the partial week at most five) and the business time of an interval is
+# the difference of that at its two ends. Holidays are found with a binary search.
+#
+
+from bisect                             import bisect_right
+from datetime                           import date, datetime, timezone
+import os
+import yaml
+
+epoch = datetime(2009, 3, 2, 0, 0, tzinfo=timezone.utc)
+
+DAY  = 86400
+WEEK = 7 * DAY
+WORK_WEEK = 5 * DAY
+
+def weekday_seconds(ts):
+    '''
+    The number of weekday seconds between the epoch and ts (negative before the epoch).
+    '''
+    weeks, rest = divmod(ts, WEEK)
+    return weeks * WORK_WEEK + min(rest, WORK_WEEK)
+
+# BusinessCalendar
+#
+class BusinessCalendar():
+    '''
+    Weekends plus an optional list of holidays. The holidays can be datetime.date
+    objects or 'YYYY-MM-DD' strings.
+    '''
+    def __init__(self, holidays=None):
+        starts = set()
+        for holiday in holidays or []:
+            if isinstance(holiday, str):
+                holiday = date.fromisoformat(holiday)
+            start = int((datetime(holiday.year, holiday.month, holiday.day, tzinfo=timezone.utc) - epoch).total_seconds())
+            if start % WEEK < WORK_WEEK:       # A holiday on a weekend doesn't take anything away
+                starts.add(start)
+        self.holidays = sorted(starts)         # The timestamp of the start of each holiday
+
+    @classmethod
+    def from_config(cls, cfg=None):
+        '''
+        The calendar described by the "business_time" section of config.yaml (or of the
+        already loaded configuration, cfg).
+        '''
+        if cfg is None:
+            cfg_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config.yaml')
+            with open(cfg_path, 'r') as f:
+                cfg = yaml.safe_load(f.read())
+        section = cfg.get('business_time') or {}
+        return cls(section.get('holidays'))
+
+    def holiday_seconds(self, ts):
+        '''
+        The number of holiday seconds before ts.
+        '''
+        holidays = self.holidays
+        passed = bisect_right(holidays, ts - DAY)
+        seconds = passed * DAY
+        if passed < len(holidays) and holidays[passed] < ts:
+            seconds += ts - holidays[passed] # ts is part way through a holiday
+        return seconds
+
+    def elapsed(self, ts):
+        '''
+        The number of business seconds between the epoch and ts.
+        '''
+        if self.holidays:
+            return weekday_seconds(ts) - self.holiday_seconds(ts)
+        return weekday_seconds(ts)
+
+    def seconds(self, end, start):
+        '''
+        The number of business seconds from start until end. Negative if end is before
+        start.
+        '''
+        return self.elapsed(end) - self.elapsed(start)
+
+    def durations(self, ends, starts):
+        '''
+        The business seconds of a whole column of intervals at once, ends[i] - starts[i]
+        for each i. As elsewhere a 0 timestamp means the date isn't known, and the
+        duration of an interval with either end 0 is 0.
+        '''
+        elapsed = self.elapsed if self.holidays else weekday_seconds
+        return [0 if end == 0 or start == 0 else elapsed(end) - elapsed(start) for end, start in zip(ends, starts)]
+
+# vi:set ts=4 sw=4 expandtab:
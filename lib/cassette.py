@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+#
+# Record and replay of the Launchpad traffic the tools generate, so that ingest can be
+# benchmarked (round trips, throughput, concurrency) without a network connection and
+# with the same responses every time.
+#
+# The cassette is controlled through the environment:
+#
+#     BUGZ_CASSETTE          The cassette file (json).
+#     BUGZ_CASSETTE_MODE     "record" to talk to Launchpad and save what comes back in the
+#                            cassette, "replay" to answer from the cassette alone.
+#     BUGZ_CASSETTE_LATENCY  When replaying, the number of seconds (float) each Launchpad
+#                            round trip should take.
+#
+# Everything reached from the launchpadlib service object is wrapped in a proxy which
+# records (or replays) every attribute, item, call and iteration by its path from the
+# service object, e.g. "bugz.bugs[2065886].bug_tasks[#3].status".
+#
+
+from datetime                           import datetime
+from urllib.request                     import urlopen
+import atexit
+import builtins
+import json
+import os
+import sys
+import threading
+import time
+
+class CassetteMiss(Exception):
+    '''
+    Raised when replaying something that isn't in the cassette.
+    '''
+    pass
+
+def plain(value):
+    '''
+    True if the value is data that can be stored in the cassette as it is, rather than
+    a launchpadlib object that has to be wrapped.
+    '''
+    if value is None or isinstance(value, (str, int, float, bool, datetime)):
+        return True
+    if isinstance(value, (list, tuple)):
+        return all(plain(v) for v in value)
+    if isinstance(value, dict):
+        return all(isinstance(k, str) and plain(v) for k, v in value.items())
+    return False
+
+def encode(value):
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, (list, tuple)):
+        return [encode(v) for v in value]
+    if isinstance(value, dict):
+        return {k: encode(v) for k, v in value.items()}
+    return value
+
+def decode(value):
+    if isinstance(value, dict):
+        if '__datetime__' in value:
+            return datetime.fromisoformat(value['__datetime__'])
+        return {k: decode(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [decode(v) for v in value]
+    return value
+
+def call_key(args, kwargs):
+    # Dates passed to searches are usually "now" less something and would never match
+    # from one run to the next, so they are left out of the key.
+    #
+    def arg(value):
+        return '<datetime>' if isinstance(value, datetime) else repr(value)
+    parts = [arg(a) for a in args] + ['%s=%s' % (k, arg(kwargs[k])) for k in sorted(kwargs)]
+    return '(' + ', '.join(parts) + ')'
+
+# Cassette
+#
+class Cassette():
+    '''
+    The recorded responses along with counts of the Launchpad round trips made (or
+    replayed). A round trip is counted the first time data is read from an object,
+    for every call and for every iteration over a collection.
+    '''
+    def __init__(self, path, mode, latency=0.0):
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.fetched = set()
+        self.round_trips = 0
+        self.misses = 0
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.entries = json.load(f)
+
+    def round_trip(self, key=None):
+        '''
+        Count a round trip. With a key, only the first one for that key is counted.
+        '''
+        with self.lock:
+            if key is not None:
+                if key in self.fetched:
+                    return
+                self.fetched.add(key)
+            self.round_trips += 1
+        if self.mode == 'replay' and self.latency:
+            time.sleep(self.latency)
+
+    def put(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+
+    def get(self, key):
+        try:
+            return self.entries[key]
+        except KeyError:
+            with self.lock:
+                self.misses += 1
+            raise CassetteMiss(key)
+
+    def save(self):
+        if self.mode == 'record':
+            # Add to what was already recorded rather than replacing it.
+            #
+            entries = {}
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as f:
+                    entries = json.load(f)
+            entries.update(self.entries)
+            with open(self.path, 'w') as f:
+                json.dump(entries, f)
+        print(f'cassette: {self.round_trips} Launchpad round trips {self.mode}ed, {self.misses} misses', file=sys.stderr)
+
+    # Values are stored as {'value': ...} and objects as {'object': True}. Recording
+    # an exception stores {'error': <class name>, 'message': ...}.
+    #
+    def record(self, key, produce):
+        try:
+            value = produce()
+        except Exception as e:
+            self.put(key, {'error': type(e).__name__, 'message': str(e)})
+            raise
+        if plain(value):
+            self.put(key, {'value': encode(value)})
+            return value
+        self.put(key, {'object': True})
+        return RecordingProxy(value, self, key)
+
+    def replay(self, key):
+        entry = self.get(key)
+        if 'error' in entry:
+            error = getattr(builtins, entry['error'], None)
+            if not (isinstance(error, type) and issubclass(error, Exception)):
+                error = RuntimeError
+            raise error(entry['message'])
+        if 'value' in entry:
+            return decode(entry['value'])
+        return ReplayProxy(self, key)
+
+# RecordingProxy
+#
+class RecordingProxy():
+    '''
+    Wraps a launchpadlib object, passing everything through to it and recording what
+    comes back.
+    '''
+    def __init__(self, target, cassette, key):
+        object.__setattr__(self, '_target', target)
+        object.__setattr__(self, '_cassette', cassette)
+        object.__setattr__(self, '_key', key)
+
+    def __getattr__(self, name):
+        key = self._key + '.' + name
+        value = self._cassette.record(key, lambda: getattr(self._target, name))
+        if not isinstance(value, RecordingProxy):
+            self._cassette.round_trip(self._key)
+        return value
+
+    def __setattr__(self, name, value):
+        setattr(self._target, name, value)
+
+    def __getitem__(self, item):
+        return self._cassette.record(self._key + '[' + repr(item) + ']', lambda: self._target[item])
+
+    def __call__(self, *args, **kwargs):
+        self._cassette.round_trip()
+        return self._cassette.record(self._key + call_key(args, kwargs), lambda: self._target(*args, **kwargs))
+
+    def __iter__(self):
+        self._cassette.round_trip()
+        items = list(self._target)
+        self._cassette.put(self._key + '[:]', {'items': len(items)})
+        for i, item in enumerate(items):
+            key = self._key + '[#' + str(i) + ']'
+            self._cassette.fetched.add(key) # It came along with the collection
+            yield self._cassette.record(key, lambda: item)
+
+    def __bool__(self):
+        return True
+
+    def __len__(self):
+        return self._cassette.record(self._key + '.__len__', lambda: len(self._target))
+
+    def __str__(self):
+        return self._cassette.record(self._key + '.__str__', lambda: str(self._target))
+
+# ReplayProxy
+#
+class ReplayProxy():
+    '''
+    Stands in for a launchpadlib object, answering everything from the cassette.
+    '''
+    def __init__(self, cassette, key):
+        object.__setattr__(self, '_cassette', cassette)
+        object.__setattr__(self, '_key', key)
+        object.__setattr__(self, '_assigned', {})
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if name in self._assigned:
+            return self._assigned[name]
+        value = self._cassette.replay(self._key + '.' + name)
+        if not isinstance(value, ReplayProxy):
+            self._cassette.round_trip(self._key)
+        return value
+
+    def __setattr__(self, name, value):
+        self._assigned[name] = value
+
+    def __getitem__(self, item):
+        return self._cassette.replay(self._key + '[' + repr(item) + ']')
+
+    def __call__(self, *args, **kwargs):
+        self._cassette.round_trip()
+        return self._cassette.replay(self._key + call_key(args, kwargs))
+
+    def __iter__(self):
+        self._cassette.round_trip()
+        entry = self._cassette.get(self._key + '[:]')
+        for i in range(entry['items']):
+            key = self._key + '[#' + str(i) + ']'
+            self._cassette.fetched.add(key)
+            yield self._cassette.replay(key)
+
+    def __bool__(self):
+        return True
+
+    def __len__(self):
+        return self._cassette.replay(self._key + '.__len__')
+
+    def __str__(self):
+        return self._cassette.replay(self._key + '.__str__')
+
+_cassette = None
+_cassette_lock = threading.Lock()
+
+def cassette():
+    '''
+    The cassette configured through the environment, or None.
+    '''
+    global _cassette
+    path = os.environ.get('BUGZ_CASSETTE')
+    if not path:
+        return None
+    with _cassette_lock:
+        if _cassette is None:
+            mode = os.environ.get('BUGZ_CASSETTE_MODE', 'replay')
+            if mode not in ('record', 'replay'):
+                raise ValueError('BUGZ_CASSETTE_MODE must be "record" or "replay", not "%s"' % mode)
+            _cassette = Cassette(path, mode, float(os.environ.get('BUGZ_CASSETTE_LATENCY', '0')))
+            atexit.register(_cassette.save)
+    return _cassette
+
+def connect(client_name, login):
+    '''
+    The launchpadlib service object for the client. login is called to log in to
+    Launchpad, unless replaying in which case nothing is logged in to.
+    '''
+    c = cassette()
+    if c is None:
+        return login()
+    if c.mode == 'replay':
+        c.round_trip()
+        return ReplayProxy(c, client_name)
+    c.round_trip()
+    return RecordingProxy(login(), c, client_name)
+
+def urlread(url):
+    '''
+    The contents of the url (bytes), recorded or replayed like the Launchpad traffic.
+    '''
+    c = cassette()
+    if c is None:
+        return urlopen(url).read()
+    key = 'url:' + url
+    c.round_trip()
+    if c.mode == 'replay':
+        return c.replay(key).encode('utf-8')
+    data = urlopen(url).read()
+    c.put(key, {'value': data.decode('utf-8')})
+    return data
+
+# vi:set ts=4 sw=4 expandtab:
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+#
+# The critical path through a bug's stages: which of them the time from the start of
+# the cycle (prepare-package In Progress) to the end (promote-to-updates Fix Released)
+# was actually spent waiting on. Many of the stages run side by side, so their
+# durations don't add up to the total.
+#
+# Working back from the end, the stage that finished last is the one that held things
+# up; whatever happened before it started is explained by the stage that finished last
+# before then, and so on back to the start. Any time in between that no stage
+# accounts for is a wait. The stages and waits on the path add up to the total.
+#
+
+WAITING = 'waiting'
+
+def critical_path(start, end, stages):
+    '''
+    The critical path from start to end through the stages, each (name, start, end)
+    with 0 for a date that isn't known. Returns a list of (name, seconds) in order,
+    the name being WAITING for time no stage accounts for, that adds up to end - start.
+    Stages missing a date, or that end before they start, are left out.
+    '''
+    intervals = [(name, s, e) for name, s, e in stages if s and e and s < e and e > start]
+    path = []
+    t = end
+    while t > start:
+        # The stage that finished last, by t, having started before it. Of those that
+        # finished at the same time the one that started first.
+        #
+        latest = None
+        for interval in intervals:
+            name, s, e = interval
+            if e <= t and s < t:
+                if latest is None or e > latest[2] or (e == latest[2] and s < latest[1]):
+                    latest = interval
+        if latest is None:
+            break
+        name, s, e = latest
+        if e < t:
+            path.append((WAITING, t - e))
+        s = max(s, start)
+        path.append((name, e - s))
+        t = s
+    if t > start:
+        path.append((WAITING, t - start))
+    path.reverse()
+    return path
+
+def attribute(path):
+    '''
+    The seconds the path spends on each stage (and waiting) as a dict.
+    '''
+    seconds = {}
+    for name, duration in path:
+        seconds[name] = seconds.get(name, 0) + duration
+    return seconds
+
+# vi:set ts=4 sw=4 expandtab:
@@ -1,5 +1,12 @@
 import os
-from launchpadlib.launchpad             import Launchpad as _Launchpad
+from lib                                import cassette
+
+try:
+    from launchpadlib.launchpad         import Launchpad as _Launchpad
+except ImportError:
+    # Replaying a cassette (see lib/cassette.py) doesn't need launchpadlib.
+    #
+    _Launchpad = None
 
 
 class Launchpad():
@@ -19,11 +26,11 @@ class Launchpad():
         if not os.path.exists(launchpad_creddir):
             os.makedirs(launchpad_creddir, 0o700)
 
-        s.service = _Launchpad.login_with(client_name,
-                                          service_root=s.__service_root,
-                                          launchpadlib_dir=launchpad_cachedir,
-                                          credentials_file=launchpad_credentials_file,
-                                          version='devel')
+        s.service = cassette.connect(client_name, lambda: _Launchpad.login_with(client_name,
+                                                                                service_root=s.__service_root,
+                                                                                launchpadlib_dir=launchpad_cachedir,
+                                                                                credentials_file=launchpad_credentials_file,
+                                                                                version='devel'))
         return
 
     # bug_url
@@ -1,25 +1,126 @@
-from launchpadlib.launchpad             import Launchpad
 from ktl.kernel_series                  import KernelSeries
+from lib                                import cassette
+import threading
 import yaml
 import os
 
+try:
+    from launchpadlib.launchpad         import Launchpad
+except ImportError:
+    # Replaying a cassette (see lib/cassette.py) doesn't need launchpadlib.
+    #
+    Launchpad = None
+
+def login():
+    client_name = 'NVIDIA tools'
+    launchpad_cachedir = os.path.join(os.path.expanduser('~'), '.cache', client_name)
+    launchpad_creddir  = os.path.join(os.path.expanduser('~'), '.config', client_name)
+    filename_parts = ['credentials', 'production']
+
+    launchpad_credentials_file = os.path.join(launchpad_creddir, '-'.join(filename_parts))
+
+    if not os.path.exists(launchpad_creddir):
+        os.makedirs(launchpad_creddir, 0o700)
+
+    return cassette.connect(client_name, lambda: Launchpad.login_with(client_name,
+                                                                      service_root='production',
+                                                                      launchpadlib_dir=launchpad_cachedir,
+                                                                      credentials_file=launchpad_credentials_file,
+                                                                      version='devel'))
+
+# Session
+#
+class Session():
+    '''
+    The process's one Launchpad client, logged in to when it's first needed, and the
+    lookups of teams, PPAs, distributions and series (and the kernel series info) made
+    through it. Each lookup is made once and remembered for the rest of the run.
+
+    Keeps count of the logins and lookups (round trips) made and of those saved: every
+    LP() after the first would have logged in again and every repeated lookup would
+    have been made again, along with any lookups it depends on (a PPA's team).
+    '''
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.launchpad = None
+        self.logins = 0
+        self.logins_saved = 0
+        self.found = {}                 # key: (value, the round trips it took)
+        self.lookups = 0
+        self.lookups_saved = 0
+        self.cost = 0                   # Round trips behind the lookup being made
+
+    def service(self):
+        with self.lock:
+            if self.launchpad is None:
+                self.launchpad = login()
+                self.logins += 1
+            return self.launchpad
+
+    def connect(self):
+        '''
+        The client, for something that would otherwise have logged in for itself.
+        '''
+        with self.lock:
+            if self.launchpad is not None:
+                self.logins_saved += 1
+            return self.service()
+
+    def lookup(self, key, fetch):
+        '''
+        What fetch() returns, only calling it the first time the key is looked up.
+        '''
+        with self.lock:
+            if key in self.found:
+                value, cost = self.found[key]
+                self.lookups_saved += cost
+                self.cost += cost
+                return value
+            outer, self.cost = self.cost, 0
+            try:
+                value = fetch()
+                self.lookups += 1
+            finally:
+                cost = self.cost + 1
+                self.cost = outer + cost
+            self.found[key] = (value, cost)
+            return value
+
+    def team(self, name):
+        return self.lookup(('team', name), lambda: self.service().people[name])
+
+    def ppa(self, team, name):
+        return self.lookup(('ppa', team, name), lambda: self.team(team).getPPAByName(name=name))
+
+    def distribution(self, name):
+        return self.lookup(('distribution', name), lambda: self.service().distributions(name))
+
+    def series(self, distribution, name):
+        return self.lookup(('series', distribution, name), lambda: self.distribution(distribution).getSeries(name_or_version=name))
+
+    def kernel_series(self):
+        return self.lookup(('kernel-series',), KernelSeries)
+
+session = Session()
+
 class LP():
+    '''
+    A handle on the session's Launchpad client and lookups.
+    '''
     def __init__(self):
-        client_name = 'NVIDIA tools'
-        launchpad_cachedir = os.path.join(os.path.expanduser('~'), '.cache', client_name)
-        launchpad_creddir  = os.path.join(os.path.expanduser('~'), '.config', client_name)
-        filename_parts = ['credentials', 'production']
+        self.launchpad = session.connect()
+
+    def team(self, name):
+        return session.team(name)
 
-        launchpad_credentials_file = os.path.join(launchpad_creddir, '-'.join(filename_parts))
+    def ppa(self, team, name):
+        return session.ppa(team, name)
 
-        if not os.path.exists(launchpad_creddir):
-            os.makedirs(launchpad_creddir, 0o700)
+    def distribution(self, name):
+        return session.distribution(name)
 
-        self.launchpad = Launchpad.login_with(client_name,
-                                              service_root='production',
-                                              launchpadlib_dir=launchpad_cachedir,
-                                              credentials_file=launchpad_credentials_file,
-                                              version='devel')
+    def series(self, distribution, name):
+        return session.series(distribution, name)
 
 class LPBug(): # Launchpad Bug
     def __init__(self, bid=None):
@@ -115,7 +216,7 @@ class KTB(LPBug): # Kernel Tracking Bug
     @property
     def build_ppas(self):
         if self._build_ppas is None:
-            ks = KernelSeries().lookup_series(codename=self.series)
+            ks = session.kernel_series().lookup_series(codename=self.series)
             src = ks.lookup_source(self.package)
             route = src.routing.lookup_route('build').routing.name
             route_table = ks.routing_table[route]['build']
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+#
+# Quantiles (p50, p90, ...) of stage durations. For small groups the durations are kept
+# and the quantiles are exact. Once a group gets large they're counted in a sketch
+# instead: a DDSketch-like histogram whose buckets grow geometrically, so that any
+# quantile it gives is within a fixed relative error of the true value, the memory it
+# takes depends on the range of the values rather than how many there are, and two
+# sketches can be merged by adding up their buckets.
+#
+# Only positive values are counted, a 0 duration means one of the dates isn't known and
+# a negative one is date skew.
+#
+
+import json
+from math                               import ceil, log
+
+EXACT_LIMIT = 2048              # The number of values a Distribution keeps before it sketches them
+RELATIVE_ACCURACY = 0.01        # A sketch's quantiles are within 1% of the true values
+
+def rank(q, count):
+    '''
+    The (0 based) rank of the q quantile (0 <= q <= 1) of count values.
+    '''
+    return int(q * (count - 1))
+
+# QuantileSketch
+#
+class QuantileSketch():
+    '''
+    A mergeable quantile sketch of positive values with the given relative accuracy.
+    '''
+    def __init__(self, relative_accuracy=RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = log(self.gamma)
+        self.buckets = {}               # bucket index: count
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value, count=1):
+        index = ceil(log(value) / self.log_gamma)
+        self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += count
+        self.sum += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def remove(self, value, count=1):
+        '''
+        Take a value that was added out again. The min and max stay exact unless it was
+        one of them, then they become the bound of the nearest bucket still holding a
+        value (within the sketch's accuracy of the true value).
+        '''
+        index = ceil(log(value) / self.log_gamma)
+        left = self.buckets.get(index, 0) - count
+        if left < 0:
+            raise ValueError('%s was not added to the sketch' % value)
+        if left:
+            self.buckets[index] = left
+        else:
+            del self.buckets[index]
+        self.count -= count
+        self.sum -= value * count
+        if not self.buckets:
+            self.min = self.max = None
+            return
+        if value <= self.min:
+            self.min = max(self.min, self.gamma ** (min(self.buckets) - 1))
+        if value >= self.max:
+            self.max = min(self.max, self.gamma ** max(self.buckets))
+
+    def dumps(self):
+        '''
+        The sketch's state as a string (json), see loads().
+        '''
+        return json.dumps({
+            'relative_accuracy' : self.relative_accuracy,
+            'buckets'           : sorted(self.buckets.items()),
+            'count'             : self.count,
+            'sum'               : self.sum,
+            'min'               : self.min,
+            'max'               : self.max,
+        })
+
+    @classmethod
+    def loads(cls, state):
+        '''
+        The sketch whose state dumps() returned.
+        '''
+        state = json.loads(state)
+        sketch = cls(state['relative_accuracy'])
+        sketch.buckets = dict(state['buckets'])
+        sketch.count = state['count']
+        sketch.sum = state['sum']
+        sketch.min = state['min']
+        sketch.max = state['max']
+        return sketch
+
+    def merge(self, other):
+        '''
+        Add the values counted by another sketch (of the same accuracy) to this one.
+        '''
+        if other.count == 0:
+            return
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('Sketches of different accuracies (%s and %s) can not be merged' % (self.relative_accuracy, other.relative_accuracy))
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def quantile(self, q):
+        if self.count == 0:
+            return 0
+        wanted = rank(q, self.count)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > wanted:
+                break
+        value = 2 * self.gamma ** index / (self.gamma + 1)
+        return min(max(value, self.min), self.max)
+
+# Distribution
+#
+class Distribution():
+    '''
+    The values of one group, with exact quantiles while there are no more than
+    exact_limit of them and a QuantileSketch's after that.
+    '''
+    def __init__(self, exact_limit=EXACT_LIMIT):
+        self.exact_limit = exact_limit
+        self.values = []
+        self.sketch = None
+
+    @property
+    def exact(self):
+        return self.sketch is None
+
+    @property
+    def count(self):
+        return len(self.values) if self.sketch is None else self.sketch.count
+
+    @property
+    def mean(self):
+        if self.sketch is not None:
+            return self.sketch.sum / self.sketch.count
+        return sum(self.values) / len(self.values) if self.values else 0
+
+    @property
+    def max(self):
+        if self.sketch is not None:
+            return self.sketch.max
+        return max(self.values) if self.values else 0
+
+    def add(self, value):
+        if value <= 0:
+            return
+        if self.sketch is not None:
+            self.sketch.add(value)
+            return
+        self.values.append(value)
+        if len(self.values) > self.exact_limit:
+            self.to_sketch()
+
+    def to_sketch(self):
+        self.sketch = QuantileSketch()
+        for value in self.values:
+            self.sketch.add(value)
+        self.values = []
+
+    def merge(self, other):
+        '''
+        Add another distribution's values to this one.
+        '''
+        if self.sketch is None and other.sketch is None and len(self.values) + len(other.values) <= self.exact_limit:
+            self.values.extend(other.values)
+            return
+        if self.sketch is None:
+            self.to_sketch()
+        if other.sketch is None:
+            for value in other.values:
+                self.sketch.add(value)
+        else:
+            self.sketch.merge(other.sketch)
+
+    def quantile(self, q):
+        if self.sketch is not None:
+            return self.sketch.quantile(q)
+        if not self.values:
+            return 0
+        self.values.sort()
+        return self.values[rank(q, len(self.values))]
+
+# vi:set ts=4 sw=4 expandtab:
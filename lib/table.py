@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+#
+# Output of the tools' colored, fixed width tables. Cells are formatted with formatters
+# and styles (escape sequences) that are worked out once per column, and the lines are
+# collected and written out a large chunk at a time instead of being printed one by one.
+#
+# When the output isn't going to a terminal the escape sequences are left out altogether
+# (the idea behind lib.colored's set_tty_aware), unless color is asked for.
+#
+
+import sys
+
+RESET = '\x1b[0m'
+
+def color_wanted(choice, out=None):
+    '''
+    Whether to color the output for a --color choice of "auto", "always" or "never".
+    "auto" colors only output going to a terminal.
+    '''
+    if choice == 'always':
+        return True
+    if choice == 'never':
+        return False
+    out = out or sys.stdout
+    return out.isatty()
+
+# Column
+#
+class Column():
+    '''
+    How the values in a column are formatted (a str.format() string, e.g. '{:>22s}')
+    and styled (escape sequences, e.g. lib.colored.fg('cyan')) unless the cell is
+    given a style of its own.
+    '''
+    def __init__(self, fmt, style=''):
+        self.format = fmt.format
+        self.style = style
+
+# Table
+#
+class Table():
+    '''
+    Collects the lines of output, writing them out whenever at least chunk characters
+    have been collected and when the table is closed (it's a context manager).
+    '''
+    def __init__(self, out=None, color=True, chunk=65536):
+        self.out = out or sys.stdout
+        self.color = color
+        self.chunk = chunk
+        self.lines = []
+        self.size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+        return False
+
+    def style(self, text, style):
+        '''
+        The text, already formatted, with the style applied.
+        '''
+        if not self.color:
+            return text
+        return style + text + RESET
+
+    def cell(self, column, value, style=None, bg=''):
+        '''
+        The value formatted for the column, in the column's style (or the given one) on
+        the given background.
+        '''
+        text = column.format(value)
+        if not self.color:
+            return text
+        return (column.style if style is None else style) + bg + text + RESET
+
+    def write(self, line=''):
+        self.lines.append(line)
+        self.size += len(line) + 1
+        if self.size >= self.chunk:
+            self.flush()
+
+    def flush(self):
+        if self.lines:
+            self.lines.append('')
+            self.out.write('\n'.join(self.lines))
+            self.lines = []
+            self.size = 0
+        self.out.flush()
+
+# vi:set ts=4 sw=4 expandtab:
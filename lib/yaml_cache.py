@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+#
+# Loading the YAML files of the tracking bugs cache (NeoConfig's tracking-bugs-cache).
+# Parsing a bug with a long history takes a while, even with libyaml, so what a file
+# parses to is pickled into a sidecar file in a cache directory of our own and used
+# for as long as the YAML file's mtime and size stay the same. A sidecar holds two
+# pickles, the file's mtime and size and then the data, so that checking whether it's
+# still good doesn't need the data to be read.
+#
+
+from collections                        import deque
+from concurrent.futures                 import ProcessPoolExecutor
+import hashlib
+import os
+import pickle
+import yaml
+
+# libyaml's loader when PyYAML was built with it, it's many times faster than the pure
+# python one.
+#
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+def cache_dir():
+    return '/'.join([os.path.expanduser('~'), '.cache', 'bugz', 'yaml'])
+
+def parse(path):
+    '''
+    What the YAML file parses to, without the cache.
+    '''
+    with open(path, 'r') as f:
+        return yaml.load(f, Loader=Loader)
+
+def sidecar(path, directory=None):
+    '''
+    The sidecar (pickle) file of a YAML file.
+    '''
+    name = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+    return os.path.join(directory or cache_dir(), name + '.pickle')
+
+def stamp(path):
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+def open_sidecar(path, directory=None):
+    '''
+    The sidecar of the YAML file, open and positioned at the data, if it was written
+    for the file as it is now. None otherwise.
+    '''
+    try:
+        f = open(sidecar(path, directory), 'rb')
+    except OSError:
+        return None
+    try:
+        if pickle.load(f) == stamp(path):
+            return f
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+        pass
+    f.close()
+    return None
+
+def fresh(path, directory=None):
+    '''
+    Whether the YAML file's sidecar is up to date.
+    '''
+    f = open_sidecar(path, directory)
+    if f is None:
+        return False
+    f.close()
+    return True
+
+def load(path, use_cache=True, directory=None):
+    '''
+    What the YAML file at path parses to, from its sidecar when that was written for
+    the file as it is now (same mtime and size), otherwise by parsing it and writing
+    the sidecar for next time. A sidecar that can't be read or written is ignored.
+    '''
+    if not use_cache:
+        return parse(path)
+
+    f = open_sidecar(path, directory)
+    if f is not None:
+        with f:
+            try:
+                return pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+                pass
+
+    current = stamp(path)
+    data = parse(path)
+    cached = sidecar(path, directory)
+    try:
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        partial = '%s.%d' % (cached, os.getpid())
+        with open(partial, 'wb') as f:
+            pickle.dump(current, f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(partial, cached)     # Readers never see a partly written sidecar
+    except OSError:
+        pass
+    return data
+
+def load_or_error(path, use_cache=True, directory=None):
+    '''
+    load(), returning (data, None) or, if the file can't be loaded, (None, the error).
+    '''
+    try:
+        return load(path, use_cache, directory), None
+    except Exception as e:
+        return None, e
+
+def load_many(paths, use_cache=True, jobs=None, directory=None):
+    '''
+    Load each of the YAML files, yielding (path, data, error) in the order given, each
+    as soon as it (and those before it) have been loaded. error is the exception for a
+    file that couldn't be loaded, and data None. The files that have to be parsed are
+    parsed on a pool of jobs processes (one per cpu by default), those with an up to
+    date sidecar are quicker to load here. Only a few files per process are loaded
+    ahead of the one being yielded, so a long list of them isn't all held in memory.
+    '''
+    paths = list(paths)
+    jobs = jobs or os.cpu_count() or 1
+    if use_cache:
+        stale = set(path for path in paths if not fresh(path, directory))
+    else:
+        stale = set(paths)
+    if jobs == 1 or len(stale) < 2:
+        for path in paths:
+            yield (path,) + load_or_error(path, use_cache, directory)
+        return
+
+    with ProcessPoolExecutor(max_workers=min(jobs, len(stale))) as pool:
+        ahead = deque()
+        for path in paths:
+            ahead.append((path, pool.submit(load_or_error, path, use_cache, directory) if path in stale else None))
+            if len(ahead) > jobs * 4:
+                yield loaded(*ahead.popleft(), use_cache, directory)
+        while ahead:
+            yield loaded(*ahead.popleft(), use_cache, directory)
+
+def loaded(path, future, use_cache, directory):
+    if future is not None:
+        return (path,) + future.result()
+    return (path,) + load_or_error(path, use_cache, directory)
+
+# vi:set ts=4 sw=4 expandtab: